@@ -2,20 +2,25 @@ from threading import Thread
 
 try:
     from pprint import pprint
-    import concurrent.futures
+    import asyncio
+    import functools
     from concurrent.futures import ThreadPoolExecutor
     import time
     import datetime
     from multiprocessing import Process
 
     from pymongo.errors import PyMongoError
-    from pymongo import UpdateOne
-    from pymongo.collection import Collection
+    from pymongo import ASCENDING
     from telegram.utils.request import Request
     from telegram import Bot
 
     import config
-    from helpers import get_collection, get_logger, Flight, APIClient, Alert
+    from helpers import (
+        get_collection, get_logger, Flight, APIClient, Alert, FlightLookupCoalescer, compute_next_check_at,
+        make_lease_owner, claim_filter, claim_alerts, iter_claims, run_bounded, LEASE_UNSET,
+    )
+    from async_api_client import AsyncAPIClient, AsyncFlightLookupCoalescer
+    from bulk_write_buffer import BulkWriteBuffer
 
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
@@ -28,7 +33,6 @@ class ActiveListener(Thread):
         This object is to check the ACTIVE alerts in the DB, and if any update, process it.
         """
         super().__init__()
-        self._futures = None
         self._logger = get_logger(
             logger_name="ACTIVE_LISTENER",
             file_name=config.ACTIVE_LISTENER_LOG_PATH,
@@ -46,94 +50,273 @@ class ActiveListener(Thread):
             token=config.TG_TOKEN,
             request=req,
         )
+        # The checks close to departure and landing come every ACTIVE_LISTENER_MIN_CHECK_INTERVAL seconds,
+        # more often than the cached responses expire, so the active lookups always ask the API.
+        # Their responses still go into the cache for the other listeners.
         self.api_client = APIClient(
             logger_name="ACTIVE_API_CLIENT",
             logger_path=config.ACTIVE_API_CLIENT_LOG_PATH,
+            read_cache=False,
         )
+        self.async_api_client = AsyncAPIClient(
+            logger_name="ACTIVE_ASYNC_API_CLIENT",
+            logger_path=config.ACTIVE_ASYNC_API_CLIENT_LOG_PATH,
+            read_cache=False,
+        )
+        self.lease_owner = make_lease_owner("ACTIVE_LISTENER")
+        self.write_buffer = BulkWriteBuffer(self._logger)
 
         self._logger.info("ActiveListener created")
 
-    def listen_to_queue(self):
-        alerts = self.active_collection.find({})
+    @staticmethod
+    def due_filter(now):
+        """
+        Return the filter of the alerts due for a check at now.
+        Alerts which were never checked have no next_check_at and are due right away.
+        """
+        return {"$or": [{"next_check_at": {"$lte": now}}, {"next_check_at": None}]}
+
+    def count_due_alerts(self):
+        """
+        Return the number of due alerts, including the ones claimed by other listeners.
+        """
         try:
-            num_alerts = self.active_collection.count_documents({})
+            return self.active_collection.count_documents(self.due_filter(time.time()))
         except PyMongoError:
             self._logger.exception("Failed to get info from the DB.")
             raise RuntimeError("Failed to get info from the DB.")
 
-        self._logger.info(f"Found {num_alerts} alerts in the active alerts, starting to process.")
-        futures = [self.thread_pool.submit(self.process_alert, alert) for alert in alerts]
-        # for debugging purposes
-        self._futures = futures
-        for future in concurrent.futures.as_completed(futures, timeout=40):
-            if future.done():
-                self._logger.info(f"Done with the current one: {future}.")
+    def claim_batch(self):
+        """
+        Claim the next LEASE_BATCH_SIZE due alerts for this listener, the most overdue first.
+        """
+        return claim_alerts(
+            self.active_collection,
+            self.due_filter(time.time()),
+            self.lease_owner,
+            config.LEASE_BATCH_SIZE,
+            sort=[("next_check_at", ASCENDING)],
+        )
+
+    def seconds_until_next_check(self):
+        """
+        Return the number of seconds until the earliest alert becomes due,
+        within ACTIVE_LISTENER_MIN_SLEEP_DURATION and ACTIVE_LISTENER_SLEEP_DURATION.
+        The alerts leased by a sweep are left out, they are rescheduled by it or claimed again once the lease expires.
+        """
+        try:
+            earliest = self.active_collection.find_one(
+                claim_filter({}, time.time()),
+                projection={"next_check_at": True},
+                sort=[("next_check_at", ASCENDING)],
+            )
+        except PyMongoError:
+            self._logger.exception("Failed to get the next due alert.")
+            return config.ACTIVE_LISTENER_SLEEP_DURATION
+        if earliest is None:
+            return config.ACTIVE_LISTENER_SLEEP_DURATION
+        wait = (earliest.get("next_check_at") or 0) - time.time()
+        return min(config.ACTIVE_LISTENER_SLEEP_DURATION, max(config.ACTIVE_LISTENER_MIN_SLEEP_DURATION, wait))
+
+    def iter_claimed_alerts(self):
+        """
+        Claim the due alerts a window of ACTIVE_LISTENER_MAX_IN_FLIGHT at a time as the sweep consumes them,
+        the most overdue first.
+        """
+        return iter_claims(
+            self.active_collection,
+            self.due_filter(time.time()),
+            self.lease_owner,
+            config.ACTIVE_LISTENER_MAX_IN_FLIGHT,
+            sort=[("next_check_at", ASCENDING)],
+        )
+
+    def listen_to_queue(self):
+        num_alerts = self.count_due_alerts()
+        self._logger.info(f"Found {num_alerts} due alerts in the active alerts, starting to process.")
+        # Every distinct flight code is requested once per sweep and shared between its alerts
+        flight_lookup = FlightLookupCoalescer(self.api_client)
+        deadline = time.time() + config.ACTIVE_LISTENER_SWEEP_DEADLINE
+        futures = run_bounded(
+            self.thread_pool,
+            functools.partial(self.process_alert, flight_lookup=flight_lookup),
+            self.iter_claimed_alerts(),
+            config.ACTIVE_LISTENER_MAX_IN_FLIGHT,
+            deadline=deadline,
+        )
+        for future in futures:
+            if future.exception() is not None:
+                self._logger.error(f"Failed to process an alert: {future.exception()!r}")
+        self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def listen_to_queue_async(self):
+        """
+        The asyncio flavour of listen_to_queue. The flight lookups run on the event loop, at most
+        ACTIVE_LISTENER_ASYNC_CONCURRENCY at a time, the rest of the processing runs in the thread pool.
+        """
+        num_alerts = self.count_due_alerts()
+        self._logger.info(f"Found {num_alerts} due alerts in the active alerts, starting to process asynchronously.")
+        flight_lookup = AsyncFlightLookupCoalescer(self.api_client, self.async_api_client)
+        semaphore = asyncio.Semaphore(config.ACTIVE_LISTENER_ASYNC_CONCURRENCY)
+        deadline = time.time() + config.ACTIVE_LISTENER_SWEEP_DEADLINE
+        try:
+            while time.time() < deadline:
+                alerts = self.claim_batch()
+                if not alerts:
+                    break
+                results = await asyncio.gather(
+                    *[self.process_alert_async(alert, flight_lookup, semaphore) for alert in alerts],
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        self._logger.error(f"Failed to process an alert: {result!r}")
+        finally:
+            await self.async_api_client.close()
+            self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def process_alert_async(self, alert_dict, flight_lookup, semaphore):
+        """
+        Prefetch the flight of the alert on the event loop, then process the alert in the thread pool.
+        Arguments:
+            :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: the AsyncFlightLookupCoalescer of the sweep
+            :param semaphore: asyncio.Semaphore limiting the number of lookups in flight
+        Returns:
+            None
+        """
+        async with semaphore:
+            await flight_lookup.prefetch(alert_dict['flight']['flight_code'])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.thread_pool, self.process_alert, alert_dict, flight_lookup)
 
     def run(self):
         while True:
             self._logger.info("Starting to listen...")
-            self.listen_to_queue()
-            time.sleep(config.ACTIVE_LISTENER_SLEEP_DURATION)
+            if config.ACTIVE_LISTENER_USE_ASYNC:
+                asyncio.run(self.listen_to_queue_async())
+            else:
+                self.listen_to_queue()
+            time.sleep(self.seconds_until_next_check())
 
-    def update_one(self, document: dict, collection: Collection):
-        try:
-            update_result = collection.update_one(
-                {"_id": document["_id"]},
-                {"$set": document},
-                upsert=True,
-            )
-        except PyMongoError:
-            self._logger.exception("Failed to insert into collection.")
-            raise RuntimeError("Failed to insert into collection.")
+    def log_api_client_stats(self):
+        if self.api_client.cache is not None:
+            self._logger.info(f"Response cache stats: {self.api_client.cache.stats()}")
+        if self.api_client.proxy_pool is not None:
+            self._logger.info(f"Proxy pool stats: {self.api_client.proxy_pool.stats()}")
+
+    @staticmethod
+    def reschedule_update(next_check_at: float):
+        """
+        Return the update setting the time of the next check of the alert and releasing its lease.
+        """
+        return {"$set": {"next_check_at": next_check_at}, "$unset": LEASE_UNSET}
+
+    @staticmethod
+    def flight_update(alert_dict: dict, old_flight: Flight, new_flight: Flight, next_check_at: float):
+        """
+        Return the update storing the new snapshot of the flight of the alert, setting only the fields which changed
+        and the fingerprint. Alerts stored before the flights carried a fingerprint get the whole flight rewritten.
+        The update also sets the time of the next check and releases the lease of the alert.
+        Arguments:
+            :param alert_dict: the stored alert
+            :param old_flight: the Flight of the stored alert
+            :param new_flight: the Flight fetched from the API
+            :param next_check_at: unix time of the next check of the alert
+        Returns:
+            the update document
+        """
+        if alert_dict['flight'].get('fingerprint') is None:
+            fields = {"flight": new_flight.to_dict()}
         else:
-            return update_result
+            fields = {f"flight.{field}": values[1] for field, values in old_flight.compare(new_flight).items()}
+            fields["flight.fingerprint"] = new_flight.fingerprint()
+        fields["next_check_at"] = next_check_at
+        return {"$set": fields, "$unset": LEASE_UNSET}
 
-    def process_alert(self, alert_dict):
+    def process_alert(self, alert_dict, flight_lookup=None):
         """
         Process the alert from the active alerts. If already landed, remove from active.
         If status changes in the flight, report to the user.
+        The alert is skipped without any further work if the fingerprint of the fetched row equals the stored one.
+        Unless removed, the alert is rescheduled with compute_next_check_at.
+        The writes go through the write buffer, the user is informed once they succeeded.
         Arguments:
             :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: object used to look the flight up, the APIClient or the sweep's
+                FlightLookupCoalescer. Defaults to None, in which case self.api_client is used.
         Returns:
             None
         """
         self._logger.info(f"Checking the alert {alert_dict['_id']}")
+        now = time.time()
         reply = None
-        current_alert = Alert.from_dict(alert_dict=alert_dict)
+        update = None
+        if flight_lookup is None:
+            flight_lookup = self.api_client
         to_delete = False
         try:
-            flight = self.api_client.get_flight_by_id(
+            match = flight_lookup.get_row_by_id(
                 flight_code=alert_dict['flight']['flight_code'],
                 flight_id=alert_dict['flight']['flight_id'],
             )
         except ValueError:
             self._logger.exception("No results found at all")
             reply = f"I could not find flight {alert_dict['flight']['flight_code']}"
+            update = self.reschedule_update(now + config.ACTIVE_LISTENER_SLEEP_DURATION)
         else:
+            flight = None
+            if match is not None:
+                flight_page, index = match
+                stored_fingerprint = alert_dict['flight'].get('fingerprint')
+                if stored_fingerprint is not None and stored_fingerprint == flight_page.fingerprint(index):
+                    self._logger.info("Nothing changed since the last check.")
+                    update = self.reschedule_update(compute_next_check_at(alert_dict['flight'], now))
+                    self.write_buffer.update(
+                        self.active_collection, alert_dict['_id'], update, owner=self.lease_owner
+                    )
+                    return
+                flight = flight_page.flight(index)
+
             if flight is None:
                 reply = f"Sorry I did not find {alert_dict['flight']['flight_code']}"
                 to_delete = True
-            elif flight.properties["Real Arrival"] is not None:
+            elif flight.real_arrival is not None:
                 self._logger.info("This flight has already arrived.")
                 reply = f"- - Your flight has already arrived - -\n"
                 reply += str(flight)
                 to_delete = True
-            elif flight.properties['Current Status'] == "Unknown":
+            elif flight.status == "Unknown":
                 self._logger.warning("Current status is missing.")
                 reply = f"Hmm, looks like I don't have info about your {flight.flight_code} flight."
                 to_delete = True
             else:
                 self._logger.info("Flight found, processing it.")
+                current_alert = Alert.from_dict(alert_dict=alert_dict)
                 new_alert = Alert(flight=flight, chat_id=alert_dict['chat_id'], alert_id=alert_dict["_id"])
                 reply = current_alert.create_status_update(new_alert)
-                if reply is not None:
-                    self.update_one(new_alert.to_dict(), self.active_collection)
+                update = self.flight_update(
+                    alert_dict,
+                    current_alert.flight,
+                    flight,
+                    compute_next_check_at(flight.to_dict(), now),
+                )
 
+        inform_user = None
         if reply is not None:
-            self.bot.send_message(
-                chat_id=alert_dict['chat_id'],
-                text=reply,
-            )
+            inform_user = functools.partial(self.bot.send_message, chat_id=alert_dict['chat_id'], text=reply)
         if to_delete:
             self._logger.info(f"Removing {alert_dict['_id']} from active queue")
-            self.active_collection.delete_one({"_id": alert_dict['_id']})
+            self.write_buffer.delete(
+                self.active_collection, alert_dict['_id'], on_success=inform_user, owner=self.lease_owner
+            )
+        else:
+            self.write_buffer.update(
+                self.active_collection, alert_dict['_id'], update, on_success=inform_user, owner=self.lease_owner
+            )
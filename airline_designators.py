@@ -0,0 +1,409 @@
+try:
+    import os
+    import json
+    import mmap
+    import struct
+    import logging
+    import tempfile
+    import threading
+
+    from pymongo.errors import PyMongoError
+
+    import config
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+def flatten_airlines(data):
+    """
+    Flatten the {country: [airlines]} data of the airline designators json into a list of airlines.
+    """
+    airlines = []
+    for country, country_airlines in data.items():
+        for airline in country_airlines:
+            airlines.append(dict(airline, country=country))
+    return airlines
+
+
+class DesignatorTable:
+    """
+    The airline designators in two dictionaries, built from a list of airlines. The first airline of a designator wins.
+    """
+    def __init__(self, airlines=()):
+        """
+        Constructor.
+        :param airlines: iterable of airline dictionaries with iata and icao keys
+        """
+        self._by_iata = {}
+        self._icao_to_iata = {}
+        for airline in airlines:
+            iata = airline.get("iata")
+            icao = airline.get("icao")
+            if iata and iata not in self._by_iata:
+                self._by_iata[iata] = airline
+            if icao and icao not in self._icao_to_iata:
+                self._icao_to_iata[icao] = iata
+
+    def __len__(self):
+        return len(self._by_iata)
+
+    def by_iata(self, iata):
+        return self._by_iata.get(iata)
+
+    def iata_for_icao(self, icao):
+        return self._icao_to_iata.get(icao)
+
+
+class DesignatorSnapshot:
+    """
+    The airline designators in a compact binary file, memory-mapped and binary searched without parsing it.
+    Layout, little endian:
+        header: magic, format version, size and mtime of the source json, number of IATA and ICAO entries
+        IATA entries sorted by code: IATA code, ICAO code, offset and length of the airline in the blob
+        ICAO entries sorted by code: ICAO code, IATA code
+        blob: the airlines as compact json
+    Codes are ASCII, padded with zero bytes up to 3 bytes, longer codes are left out.
+    The size and mtime of the source tell whether the snapshot is older than the json it was made of.
+    """
+    MAGIC = b"ADSN"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHQqII")
+    CODE_WIDTH = 3
+    IATA_ENTRY = struct.Struct("<3s3sIH")
+    ICAO_ENTRY = struct.Struct("<3s3s")
+
+    def __init__(self, path):
+        """
+        Open and map the snapshot.
+        :param path: the file path of the snapshot
+        Raise ValueError if the file is not a snapshot of the current format.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._map) < self.HEADER.size:
+                raise ValueError(f"{path} is too short for a designator snapshot")
+            magic, version, self.source_size, self.source_mtime_ns, self._num_iata, self._num_icao = \
+                self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"{path} is not a version {self.VERSION} designator snapshot")
+        except ValueError:
+            self._map.close()
+            raise
+        self._iata_offset = self.HEADER.size
+        self._icao_offset = self._iata_offset + self._num_iata * self.IATA_ENTRY.size
+        self._blob_offset = self._icao_offset + self._num_icao * self.ICAO_ENTRY.size
+
+    def __len__(self):
+        return self._num_iata
+
+    def close(self):
+        self._map.close()
+
+    @staticmethod
+    def source_stamp(source_path):
+        """
+        Return the (size, mtime_ns) of the source json, (0, 0) if there is none.
+        """
+        if source_path is None:
+            return 0, 0
+        stat = os.stat(source_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_fresh(self, source_path):
+        """
+        Return True if the snapshot was made of the current version of the source json.
+        """
+        try:
+            return (self.source_size, self.source_mtime_ns) == self.source_stamp(source_path)
+        except OSError:
+            # Without the source there is nothing fresher to rebuild from
+            return True
+
+    @classmethod
+    def _code(cls, value):
+        """
+        Return the code as padded bytes, None if it is empty or does not fit.
+        """
+        if not value:
+            return None
+        try:
+            code = value.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+        if len(code) > cls.CODE_WIDTH:
+            return None
+        return code.ljust(cls.CODE_WIDTH, b"\0")
+
+    @classmethod
+    def write(cls, airlines, path, source_path=None):
+        """
+        Write the snapshot of the airlines, replacing the file at once so open snapshots are not disturbed.
+        :param airlines: list of airline dictionaries with iata and icao keys
+        :param path: the file path of the snapshot
+        :param source_path: the json the airlines were read from, to detect when the snapshot gets stale
+        :return: None
+        """
+        by_iata = {}
+        icao_to_iata = {}
+        for airline in airlines:
+            iata = cls._code(airline.get("iata"))
+            icao = cls._code(airline.get("icao"))
+            if iata is not None and iata not in by_iata:
+                by_iata[iata] = airline
+            if icao is not None and icao not in icao_to_iata:
+                icao_to_iata[icao] = iata or b""
+
+        blob = bytearray()
+        iata_entries = bytearray()
+        for iata in sorted(by_iata):
+            airline = by_iata[iata]
+            encoded = json.dumps(airline, separators=(",", ":")).encode()
+            icao = cls._code(airline.get("icao")) or b""
+            iata_entries += cls.IATA_ENTRY.pack(iata, icao, len(blob), len(encoded))
+            blob += encoded
+        icao_entries = bytearray()
+        for icao in sorted(icao_to_iata):
+            icao_entries += cls.ICAO_ENTRY.pack(icao, icao_to_iata[icao])
+
+        source_size, source_mtime_ns = cls.source_stamp(source_path)
+        header = cls.HEADER.pack(cls.MAGIC, cls.VERSION, source_size, source_mtime_ns, len(by_iata), len(icao_to_iata))
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".designators-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(iata_entries)
+                f.write(icao_entries)
+                f.write(blob)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def open_or_rebuild(cls, path, source_path):
+        """
+        Open the snapshot, rebuilding it from the source json first if it is missing, stale or of another version.
+        :param path: the file path of the snapshot
+        :param source_path: the file path of the airline designators json
+        :return: DesignatorSnapshot
+        Raise OSError or ValueError if the snapshot can neither be opened nor rebuilt.
+        """
+        try:
+            snapshot = cls(path)
+        except (OSError, ValueError):
+            snapshot = None
+        if snapshot is not None:
+            if snapshot.is_fresh(source_path):
+                return snapshot
+            snapshot.close()
+        with open(source_path) as f:
+            airlines = flatten_airlines(json.load(f))
+        cls.write(airlines, path, source_path)
+        return cls(path)
+
+    def _search(self, offset, count, entry, key):
+        """
+        Binary search the sorted entries for the key, return the unpacked entry or None.
+        """
+        low, high = 0, count
+        width = self.CODE_WIDTH
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * entry.size
+            current = self._map[position:position + width]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return entry.unpack_from(self._map, position)
+        return None
+
+    def by_iata(self, iata):
+        code = self._code(iata)
+        if code is None:
+            return None
+        found = self._search(self._iata_offset, self._num_iata, self.IATA_ENTRY, code)
+        if found is None:
+            return None
+        _, _, start, length = found
+        start += self._blob_offset
+        return json.loads(self._map[start:start + length])
+
+    def iata_for_icao(self, icao):
+        code = self._code(icao)
+        if code is None:
+            return None
+        found = self._search(self._icao_offset, self._num_icao, self.ICAO_ENTRY, code)
+        if found is None:
+            return None
+        return found[1].rstrip(b"\0").decode("ascii") or None
+
+
+class AirlineDesignatorIndex:
+    """
+    An in-memory index of the airline designators for IATA -> airline and ICAO -> IATA lookups.
+    It starts from the memory-mapped DesignatorSnapshot, so the process is ready without parsing any json,
+    then a background thread loads the airline designator collection and refreshes it periodically.
+    Without a usable snapshot, it is loaded from the collection, or from the AIRLINE_IATA_ICAO_JSON file written by
+    update_airline_codes.py if the collection can not be read.
+    A refresh rewrites the snapshot and maps the new one in at once, so lookups never wait for MongoDB
+    and keep being served from the last good load while it is slow or down. Only when the snapshot can not be
+    written, the airlines are held in a DesignatorTable instead.
+    The replaced snapshot is closed on the next swap, so the lookups still running on it can finish.
+    """
+    def __init__(
+            self,
+            collection=None,
+            json_path=config.AIRLINE_IATA_ICAO_JSON,
+            snapshot_path=config.AIRLINE_DESIGNATOR_SNAPSHOT,
+            refresh_interval=config.AIRLINE_INDEX_REFRESH_INTERVAL,
+            logger=None):
+        """
+        Constructor.
+        :param collection: pymongo collection of the airline designators, None to load the json file only
+        :param json_path: the file path of the airline designators json, None to load the collection only
+        :param snapshot_path: the file path of the DesignatorSnapshot made of the json, None to not use one
+        :param refresh_interval: number of seconds between two refreshes of the background thread
+        :param logger: logger to report the loads to, the module logger if None
+        """
+        self.collection = collection
+        self.json_path = json_path
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.logger = logger or logging.getLogger(__name__)
+        # DesignatorTable or DesignatorSnapshot, replaced as a whole on every load
+        self._table = DesignatorTable()
+        # The snapshot replaced by the last swap, closed by the next one
+        self._retired = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._table)
+
+    def _read_collection(self):
+        projection = {"_id": False, "name": True, "full_name": True, "iata": True, "icao": True, "country": True}
+        return list(self.collection.find({}, projection=projection))
+
+    def _read_json(self):
+        with open(self.json_path) as f:
+            return flatten_airlines(json.load(f))
+
+    def load(self):
+        """
+        Load the airlines from the collection, falling back to the json file, and swap the new index in.
+        The current index is kept if neither source can be read.
+        :return: True if the index was loaded
+        """
+        sources = []
+        if self.collection is not None:
+            sources.append(("collection", self._read_collection))
+        if self.json_path is not None:
+            sources.append(("json file", self._read_json))
+        for source, read in sources:
+            try:
+                airlines = read()
+            except (PyMongoError, OSError, ValueError):
+                self.logger.exception(f"Failed to load the airline designators from the {source}.")
+                continue
+            if not airlines:
+                self.logger.warning(f"No airline designators in the {source}.")
+                continue
+            self._swap(self._build_table(airlines))
+            self.logger.info(f"Loaded {len(self)} airline designators from the {source}.")
+            return True
+        return False
+
+    def _build_table(self, airlines):
+        """
+        Return the airlines as a freshly written snapshot, or as a DesignatorTable if there is no usable snapshot path.
+        """
+        if self.snapshot_path is not None:
+            try:
+                source_path = self.json_path if self.json_path and os.path.exists(self.json_path) else None
+                DesignatorSnapshot.write(airlines, self.snapshot_path, source_path=source_path)
+                return DesignatorSnapshot(self.snapshot_path)
+            except (OSError, ValueError):
+                self.logger.exception("Failed to rewrite the airline designator snapshot, keeping them in memory.")
+        return DesignatorTable(airlines)
+
+    def _swap(self, table):
+        """
+        Swap the table in and close the snapshot retired by the previous swap.
+        """
+        previous = self._table
+        self._table = table
+        if self._retired is not None:
+            self._retired.close()
+        self._retired = previous if isinstance(previous, DesignatorSnapshot) else None
+
+    def load_snapshot(self):
+        """
+        Swap in the memory-mapped snapshot, rebuilding it from the json first if it is stale.
+        :return: True if the snapshot is in use
+        """
+        if self.snapshot_path is None or self.json_path is None:
+            return False
+        try:
+            snapshot = DesignatorSnapshot.open_or_rebuild(self.snapshot_path, self.json_path)
+        except (OSError, ValueError):
+            self.logger.exception("Failed to open the airline designator snapshot.")
+            return False
+        self._swap(snapshot)
+        self.logger.info(f"Mapped {len(self)} airline designators from {self.snapshot_path}.")
+        return True
+
+    def _refresh_forever(self, load_first):
+        if load_first:
+            self.load()
+        while not self._stop.wait(self.refresh_interval):
+            self.load()
+
+    def start(self):
+        """
+        Make the index available and start the background refresh.
+        With a usable snapshot the collection is loaded in the background, otherwise right away.
+        :return: self
+        """
+        mapped = self.load_snapshot()
+        if not mapped:
+            self.load()
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._refresh_forever,
+                args=(mapped and self.collection is not None,),
+                name="airline-designators",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the background refresh and close the retired snapshot.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._retired is not None:
+            self._retired.close()
+            self._retired = None
+
+    def by_iata(self, iata):
+        """
+        Return the airline with the IATA code, None if unknown.
+        """
+        return self._table.by_iata(iata)
+
+    def iata_for_icao(self, icao):
+        """
+        Return the IATA code of the airline with the ICAO code.
+        :return: the IATA code, None if the airline is unknown or has no IATA code
+        """
+        return self._table.iata_for_icao(icao)
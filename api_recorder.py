@@ -0,0 +1,141 @@
+try:
+    import os
+    import json
+    import threading
+    from collections import defaultdict
+
+    import config
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+class ResponseRecorder:
+    """
+    Appends every upstream response to a JSONL file, one line per request:
+        {"endpoint", "started_at", "latency", "status", "body", "error"}
+    The endpoint is recorded relative to the api_url of the client, so a recording made against the real API
+    can be replayed by a client with any other base url.
+    status and body are None for requests which failed before getting a response, error holds the reason.
+    Several processes can record into the same file, every line is written with a single append.
+    """
+    def __init__(self, path=config.API_RECORD_PATH):
+        """
+        Constructor.
+        :param path: the file path of the recording, created if missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, end_point, started_at, latency, status=None, body=None, error=None):
+        """
+        Append a single request to the recording.
+        :param end_point: the requested endpoint, relative to the api_url
+        :param started_at: unix time of the start of the request
+        :param latency: duration of the request in seconds
+        :param status: the HTTP status code, None if there was no response
+        :param body: the text of the response body, None if there was no response
+        :param error: description of the failure, None if there was a response
+        :return: None
+        """
+        line = json.dumps({
+            "endpoint": end_point,
+            "started_at": started_at,
+            "latency": latency,
+            "status": status,
+            "body": body,
+            "error": error,
+        })
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class ResponseReplayer:
+    """
+    Serves the responses of a recording instead of making requests.
+    The responses of an endpoint are served in the recorded order, after the last one it starts over.
+    With speed set, every response is delayed by its recorded latency divided by speed,
+    so 1 replays at the recorded speed and 2 twice as fast. Without it the responses are served right away.
+    """
+    def __init__(self, path=config.API_REPLAY_PATH, speed=config.API_REPLAY_SPEED):
+        """
+        Constructor.
+        :param path: the file path of the recording made by ResponseRecorder
+        :param speed: latency scale, None to serve without delay
+        """
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._entries = defaultdict(list)
+        self._positions = defaultdict(int)
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self._entries[entry["endpoint"]].append(entry)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def next_entry(self, end_point):
+        """
+        Return the next recorded entry of the endpoint.
+        :param end_point: the requested endpoint, relative to the api_url
+        :return: dictionary of the recorded request
+        Raises KeyError if the endpoint was never recorded.
+        """
+        with self._lock:
+            entries = self._entries.get(end_point)
+            if not entries:
+                raise KeyError(f"No recorded response for {end_point}")
+            position = self._positions[end_point]
+            self._positions[end_point] = (position + 1) % len(entries)
+        return entries[position]
+
+    def delay(self, entry):
+        """
+        Return the number of seconds to wait before serving the entry.
+        """
+        if self.speed is None or self.speed <= 0:
+            return 0
+        return entry["latency"] / self.speed
+
+
+_recorder = None
+_replayer = None
+_lock = threading.Lock()
+
+
+def get_recorder():
+    """
+    Return the recorder of the process, creating it on first use.
+    Return None if config.API_RECORD_PATH is not set.
+    """
+    global _recorder
+    if not config.API_RECORD_PATH:
+        return None
+    with _lock:
+        if _recorder is None:
+            _recorder = ResponseRecorder()
+    return _recorder
+
+
+def get_replayer():
+    """
+    Return the replayer of the process, loading the recording on first use.
+    Return None if config.API_REPLAY_PATH is not set.
+    """
+    global _replayer
+    if not config.API_REPLAY_PATH:
+        return None
+    with _lock:
+        if _replayer is None:
+            _replayer = ResponseReplayer()
+    return _replayer
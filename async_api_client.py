@@ -0,0 +1,258 @@
+try:
+    import time
+    import asyncio
+    from urllib.parse import urlsplit
+
+    import aiohttp
+
+    import config
+    from helpers import APIClient, FlightLookupCoalescer, FlightPage, decode_json
+    from rate_limiter import parse_retry_after
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+class AsyncAPIClient(APIClient):
+    """
+    The asyncio flavour of the APIClient. The request methods are coroutines, while building the endpoints,
+    parsing and matching the flights are inherited from the APIClient.
+    The aiohttp session is bound to the running loop, so it is created on the first request and
+    has to be closed with close() before the loop finishes.
+    """
+    def __init__(
+            self,
+            logger_name="ASYNC_API_CLIENT",
+            logger_path="logs/async_api_client.log",
+            proxies=None,
+            timeout=(config.API_CONNECT_TIMEOUT, config.API_READ_TIMEOUT),
+            cache=None,
+            read_cache=True,
+            rate_limiter=None,
+            proxy_pool=None,
+            api_url=config.API_URL,
+            recorder=None,
+            replayer=None,
+            limit=config.API_ASYNC_CONNECTION_LIMIT,
+            limit_per_host=config.API_ASYNC_LIMIT_PER_HOST):
+        """
+        Constructor.
+        :param logger_name: the name of the logger, defaults to ASYNC_API_CLIENT
+        :param logger_path: the file path to log into, defaults to async_api_client.log
+        :param proxies: dictionary of proxies by url scheme, same as for the APIClient. Defaults to None
+        :param timeout: (connect, read) timeouts of a single request in seconds
+        :param cache: ResponseCache shared with the APIClient, see APIClient for the default.
+        :param read_cache: see APIClient
+        :param rate_limiter: RateLimiter shared with the APIClient, see APIClient for the default.
+        :param proxy_pool: ProxyPool shared with the APIClient, see APIClient for the default.
+            aiohttp supports only http proxies.
+        :param api_url: base url of the API, defaults to config.API_URL
+        :param recorder: ResponseRecorder shared with the APIClient, see APIClient for the default.
+        :param replayer: ResponseReplayer shared with the APIClient, see APIClient for the default.
+        :param limit: maximum number of simultaneous connections
+        :param limit_per_host: maximum number of simultaneous connections to a single host
+        """
+        super().__init__(
+            logger_name=logger_name,
+            logger_path=logger_path,
+            proxies=proxies,
+            timeout=timeout,
+            cache=cache,
+            read_cache=read_cache,
+            rate_limiter=rate_limiter,
+            proxy_pool=proxy_pool,
+            api_url=api_url,
+            recorder=recorder,
+            replayer=replayer,
+        )
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._aiohttp_session = None
+
+    def _get_aiohttp_session(self):
+        """
+        Return the aiohttp session of the running loop, creating it on first use.
+        """
+        if self._aiohttp_session is None or self._aiohttp_session.closed:
+            connect_timeout, read_timeout = self.timeout
+            self._aiohttp_session = aiohttp.ClientSession(
+                headers=self.request_base_headers,
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            )
+        return self._aiohttp_session
+
+    async def close(self):
+        """
+        Close the aiohttp session if it was opened.
+        """
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+            self._aiohttp_session = None
+
+    async def acquire_rate_limit(self, rate_limiter):
+        """
+        Wait for a token of the rate limiter without blocking the loop.
+        :param rate_limiter: the RateLimiter picked for the request, None if not limited
+        """
+        if rate_limiter is None:
+            return
+        while True:
+            wait = rate_limiter.try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def make_request(self, end_point, proxies=None):
+        """
+        Make the request and return the JSON of the response if successful.
+        If any errors occur during the request or the error code is not ok, raise RuntimeError.
+        :param end_point: the url of the endpoint which should be accessed.
+        :param proxies: dictionary of alternative proxies. Defaults to None. If None, the self.proxies will be used,
+            or a proxy of the proxy pool if self.proxies is None as well.
+        :return: dictionary of the response
+        """
+        if self.replayer is not None:
+            entry = self.get_replay_entry(end_point)
+            await asyncio.sleep(self.replayer.delay(entry))
+            return self.decode_replay_entry(entry)
+
+        proxies, pool_proxy, rate_limiter = self.pick_egress(proxies)
+        proxy = None
+        if proxies is not None:
+            proxy = proxies.get(urlsplit(end_point).scheme)
+        session = self._get_aiohttp_session()
+        await self.acquire_rate_limit(rate_limiter)
+        started_at = time.monotonic()
+        requested_at = time.time()
+        try:
+            self.logger.info(f"Requesting '{end_point}'")
+            async with session.get(end_point, proxy=proxy) as r:
+                body = await r.read()
+                self.report_egress(pool_proxy, started_at, ok=r.ok)
+                if self.recorder is not None:
+                    self.recorder.record(
+                        self.relative_endpoint(end_point),
+                        requested_at,
+                        time.monotonic() - started_at,
+                        r.status,
+                        body.decode(errors="replace"),
+                    )
+                if rate_limiter is not None:
+                    rate_limiter.report(r.status, parse_retry_after(r.headers.get("Retry-After")))
+                if not r.ok:
+                    self.logger.error(f"Status code is not ok: {r.status}")
+                    raise RuntimeError(f"Request failed: {r.status}")
+                return decode_json(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.report_egress(pool_proxy, started_at, ok=False)
+            if self.recorder is not None:
+                self.recorder.record(
+                    self.relative_endpoint(end_point), requested_at, time.monotonic() - started_at, error=repr(e)
+                )
+            self.logger.exception("Exception occurred during request:")
+            raise RuntimeError(f"Error in request: {e}")
+        except ValueError as e:
+            self.logger.exception("Response is not a valid JSON:")
+            raise RuntimeError(f"Invalid response: {e}")
+
+    async def get_flight(self, flight_code, page=1):
+        """
+        Query the API using the flight code
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: return the response component from the result component if request was successful.
+        Raises ValueError if the appropriate information is not found in the response.
+        """
+        if self.cache is not None and self.read_cache:
+            response = self.cache.get(flight_code, page)
+            if response is not None:
+                self.logger.info(f"Cache hit for {flight_code}, page {page}")
+                return response
+        resp = await self.make_request(self.get_flight_endpoint(flight_code, page))
+        response = self.extract_response(resp)
+        if self.cache is not None:
+            self.cache.set(flight_code, page, response)
+        return response
+
+    async def get_flight_page(self, flight_code, page=1):
+        """
+        Query the API using the flight code and wrap the page into a FlightPage.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: FlightPage of the response, the flights are parsed only when matched.
+        """
+        return FlightPage(await self.get_flight(flight_code, page=page))
+
+    async def get_flight_by_id(self, flight_code, flight_id, max_pages=config.API_MAX_PAGES):
+        """
+        Query the API using the flight id and flight code, requesting the next page only if needed.
+        :param flight_code: flight code containing airline code and flight number
+        :param flight_id: flight id given by the flightradar24 API
+        :param max_pages: maximum number of pages to request
+        :return: Flight object created from the found flight data. None if not found.
+        """
+        pages = []
+        for page in range(1, max_pages + 1):
+            flight_page = await self.get_flight_page(flight_code, page)
+            pages.append(flight_page)
+            if not flight_page.has_more or flight_page.find_by_id(flight_id) is not None:
+                break
+        return self.find_flight_by_id(pages, flight_id)
+
+    async def get_flight_by_date(self, flight_code, date, max_pages=config.API_MAX_PAGES):
+        """
+        Query the API using the flight code and date, requesting the next page only if needed.
+        See APIClient.find_flight_by_date for when the search stops.
+        :param flight_code: flight code containing airline code and flight number
+        :param date: a datetime object with the requested flight departure date.
+        :param max_pages: maximum number of pages to request
+        :return: Flight object created from the found flight data. None if not found.
+        """
+        day_start, day_end = FlightPage.day_bounds(date)
+        pages = []
+        try:
+            for page in range(1, max_pages + 1):
+                flight_page = await self.get_flight_page(flight_code, page)
+                pages.append(flight_page)
+                curr_flight, passed = flight_page.find_by_departure(day_start, day_end)
+                if not flight_page.has_more or curr_flight is not None or passed:
+                    break
+        except ValueError:
+            self.logger.exception("No results found at all")
+            raise ValueError("No results found at all")
+        return self.find_flight_by_date(pages, date)
+
+
+class AsyncFlightLookupCoalescer(FlightLookupCoalescer):
+    """
+    A FlightLookupCoalescer which can be filled from an event loop.
+    The alerts prefetch their flight codes with the AsyncAPIClient, after which the synchronous lookups
+    of the process_alert running in the thread pool are served without any requests.
+    """
+    def __init__(self, api_client, async_api_client):
+        """
+        Constructor.
+        :param api_client: an instance of APIClient used for lookups which were not prefetched
+        :param async_api_client: an instance of AsyncAPIClient used for the prefetching
+        """
+        super().__init__(api_client)
+        self.async_api_client = async_api_client
+
+    async def prefetch(self, flight_code, page=1):
+        """
+        Request the flight code and page unless it is already requested, and wait until the result is available.
+        Errors are stored for the synchronous lookups and are not raised here.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: None
+        """
+        lookup, is_owner = self._claim(flight_code, page)
+        if is_owner:
+            try:
+                lookup.set_result(await self.async_api_client.get_flight_page(flight_code, page=page))
+            except Exception as e:
+                lookup.set_exception(e)
+        else:
+            await asyncio.wait([asyncio.wrap_future(lookup)])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+try:
+    import os
+    import sys
+    import glob
+    import html
+    import json
+    import time
+    import argparse
+    import statistics
+
+    import config
+    from update_airline_codes import PARSE_ENGINES, PoliteFetcher, get_country_list
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+# The fixtures committed with the repository, built by generate_fixtures
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "airline_pages")
+
+
+def fixture_file_name(country):
+    return "".join(char if char.isalnum() else "_" for char in country) + ".html"
+
+
+def render_record(airline):
+    """
+        Render an airline as a record of the result page, with the markup parse_airlines looks for.
+    """
+    def escape(value):
+        return html.escape(value or "")
+
+    return (
+        '<div class="record"><p>Current Record</p><table>\n'
+        f'<tr><td><b>{escape(airline.get("name"))}</b><!-- name --></td><td>Callsign:&nbsp;-</td></tr>\n'
+        f'<tr><td>IATA Code:&nbsp;{escape(airline.get("iata"))}*</td>'
+        f'<td>ICAO Code:&nbsp;{escape(airline.get("icao"))}</td></tr>\n'
+        f'<tr><td>Full Name:{escape(airline.get("full_name"))}</td><td>Country:&nbsp;-</td></tr>\n'
+        '</table></div>\n'
+        '<div class="record"><p>Historic Record</p><table><tr><td>IATA Code:&nbsp;ZZ</td></tr></table></div>\n'
+    )
+
+
+def generate_fixtures(directory, count, json_path=config.AIRLINE_IATA_ICAO_JSON):
+    """
+        Build result pages from the airlines of the json, so the engines can be compared without the site.
+        The pages are synthetic: the records carry the markup parse_airlines relies on, with noise around them
+        (historic records, comments, entities) and every other page nests its records in an outer div.
+        Arguments:
+            directory: where to write the <country>.html files
+            count: number of countries, spread over the json from the smallest to the largest
+            json_path: the json written by update_airline_codes.py
+        Returns:
+            None
+    """
+    with open(json_path) as f:
+        data = json.load(f)
+    countries = sorted(data, key=lambda country: (len(data[country]), country))
+    step = max(1, len(countries) // count)
+    os.makedirs(directory, exist_ok=True)
+    for index, country in enumerate(countries[::step][:count]):
+        records = "".join(render_record(airline) for airline in data[country])
+        if index % 2:
+            records = f'<div id="results">\n{records}</div>\n'
+        page = (
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Airline Codes</title></head><body>\n'
+            f'<div id="search"><p>Search results for {html.escape(country)}</p></div>\n'
+            f'{records}<p>End of results</p></body></html>\n'
+        )
+        with open(os.path.join(directory, fixture_file_name(country)), "w") as f:
+            f.write(page)
+
+
+def download_fixtures(directory, limit):
+    """
+        Save the result pages of the first countries as fixtures.
+        Arguments:
+            directory: where to write the <country>.html files
+            limit: number of countries to download
+        Returns:
+            None
+    """
+    os.makedirs(directory, exist_ok=True)
+    fetcher = PoliteFetcher()
+    for country in get_country_list()[:limit]:
+        data = config.DATA.copy()
+        data["country"] = country
+        try:
+            page = fetcher.post(config.AIRLINE_INFO_URL, data, config.HEADERS)
+        except ValueError as e:
+            print(f"Failed to download {country}, skipping: {e}")
+            continue
+        with open(os.path.join(directory, fixture_file_name(country)), "w") as f:
+            f.write(page)
+        print(f"Saved {country}")
+
+
+def load_fixtures(directory):
+    """
+        Read the html fixtures of the directory.
+        Returns:
+            list of tuples (file name, page)
+    """
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path) as f:
+            fixtures.append((os.path.basename(path), f.read()))
+    return fixtures
+
+
+def check_engines(fixtures, engines):
+    """
+        Parse every fixture with every engine and compare the records with the ones of the first engine.
+        Returns:
+            list of (file name, engine) whose records differ
+    """
+    mismatches = []
+    for name, page in fixtures:
+        reference = engines[0][1](page)
+        for engine_name, parse in engines[1:]:
+            if parse(page) != reference:
+                mismatches.append((name, engine_name))
+    return mismatches
+
+
+def time_engine(parse, fixtures, repeat):
+    """
+        Parse all the fixtures repeat times.
+        Returns:
+            list of the seconds every round took
+    """
+    rounds = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        for _, page in fixtures:
+            parse(page)
+        rounds.append(time.perf_counter() - started_at)
+    return rounds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the html extraction engines of update_airline_codes.py.")
+    parser.add_argument(
+        "fixtures",
+        nargs="?",
+        default=FIXTURES_DIR,
+        help="directory of saved country result pages (*.html), defaults to the committed fixtures",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed rounds per engine")
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=sorted(PARSE_ENGINES),
+        default=sorted(PARSE_ENGINES),
+        help="the first engine is the reference the records of the others are compared with",
+    )
+    parser.add_argument("--download", type=int, default=0, metavar="N", help="first save the pages of N countries")
+    parser.add_argument(
+        "--generate",
+        type=int,
+        default=0,
+        metavar="N",
+        help="first build the synthetic pages of N countries from the airline json",
+    )
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        generate_fixtures(args.fixtures, args.generate)
+    if args.download:
+        download_fixtures(args.fixtures, args.download)
+    fixtures = load_fixtures(args.fixtures)
+    if not fixtures:
+        print(f"No *.html fixtures in {args.fixtures}")
+        return 1
+    engines = [(name, PARSE_ENGINES[name]) for name in args.engines]
+
+    mismatches = check_engines(fixtures, engines)
+    for name, engine_name in mismatches:
+        print(f"{engine_name} does not return the records of {engines[0][0]} for {name}")
+
+    size = sum(len(page) for _, page in fixtures)
+    print(f"{len(fixtures)} fixtures, {size / 1024:.0f} KiB, best and median of {args.repeat} rounds:")
+    for engine_name, parse in engines:
+        rounds = time_engine(parse, fixtures, args.repeat)
+        print(f"{engine_name:>6}: {min(rounds) * 1000:9.1f} ms {statistics.median(rounds) * 1000:9.1f} ms")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
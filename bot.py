@@ -19,6 +19,7 @@ try:
     from helpers import process_flight_code, process_date
     from helpers import get_logger, get_collection
     from helpers import validate_queue_and_inform_user
+    from airline_designators import AirlineDesignatorIndex
 
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
@@ -45,6 +46,11 @@ airline_designator_collection = get_collection(
             collection_name=config.AIRLINE_DESIGNATOR_COLLECTION,
         )
 
+airline_designator_index = AirlineDesignatorIndex(
+    collection=airline_designator_collection,
+    logger=logger,
+).start()
+
 
 def log_error(func):
     def inner(*args, **kwargs):
@@ -129,6 +135,7 @@ def flight_code_handler(update: Update, context: CallbackContext):
         flight_data = process_flight_code(
             flight_code=update.message.text,
             airline_designator_collection=airline_designator_collection,
+            airline_designator_index=airline_designator_index,
         )
     except ValueError as exception:
         context.bot.send_message(
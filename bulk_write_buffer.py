@@ -0,0 +1,244 @@
+try:
+    import time
+    import threading
+
+    from pymongo import UpdateOne, DeleteOne, DeleteMany
+    from pymongo.errors import BulkWriteError, PyMongoError
+
+    import config
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+class BulkWriteBuffer:
+    """
+    Collects the writes of a listener and sends them with unordered bulk_write calls, one per collection.
+    The buffer is flushed once it holds max_size writes or its oldest write has waited max_delay seconds,
+    and the listeners flush it at the end of every sweep.
+    Every write can carry a callback which is called once the write succeeded. move builds on it: the document
+    is deleted from the source collection only after its upsert into the target succeeded, so a failed item
+    stays where it was and is picked up again.
+    The writes given the owner of a lease only apply while that listener still holds the lease of the document.
+    Before a flush sends the ones carrying a callback, it renews their leases and reads back which are still held,
+    with one update_many and one find per collection. The writes whose lease was lost are dropped without calling
+    their callback: the listener which claimed the document next writes and follows it up instead.
+    The guarded deletions of an owner are sent as one DeleteMany per collection.
+    """
+    def __init__(
+            self,
+            logger,
+            max_size=config.BULK_WRITE_MAX_SIZE,
+            max_delay=config.BULK_WRITE_MAX_DELAY,
+            lease_duration=config.LEASE_DURATION):
+        """
+        Constructor.
+        :param logger: the logger of the listener, the failed writes are reported to it
+        :param max_size: number of buffered writes which triggers a flush
+        :param max_delay: number of seconds the oldest buffered write may wait before a flush is triggered
+        :param lease_duration: number of seconds the leases confirmed by a flush are renewed for
+        """
+        self.logger = logger
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lease_duration = lease_duration
+        self._lock = threading.Lock()
+        # Reentrant, the callbacks run by a flush may add writes which trigger another one
+        self._flush_lock = threading.RLock()
+        self._pending = []
+        self._oldest = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    @staticmethod
+    def id_filter(document_id, owner=None):
+        """
+        Return the filter of the document, restricted to the listener holding its lease if owner is given.
+        """
+        if owner is None:
+            return {"_id": document_id}
+        return {"_id": document_id, "lease_owner": owner}
+
+    def add(self, collection, request, on_success=None, lease=None):
+        """
+        Buffer a write, flushing the buffer if it is full or its oldest write waited long enough.
+        :param collection: pymongo collection to write to
+        :param request: pymongo write request, for example UpdateOne or DeleteOne
+        :param on_success: function without arguments called once the write succeeded
+        :param lease: tuple (collection, owner, document id) of the lease the write depends on, None if it does not.
+            A write with a callback is only sent while owner still holds that lease.
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._pending.append((collection, request, on_success, lease))
+            if self._oldest is None:
+                self._oldest = now
+            due = len(self._pending) >= self.max_size or now - self._oldest >= self.max_delay
+        if due:
+            self.flush()
+
+    def update(self, collection, document_id, update, upsert=False, on_success=None, owner=None):
+        """
+        Buffer an update of the document with the id, only while owner holds its lease if given.
+        """
+        if upsert and owner is not None:
+            raise ValueError("An upsert would insert the document again once the lease is lost.")
+        request = UpdateOne(self.id_filter(document_id, owner), update, upsert=upsert)
+        lease = None if owner is None else (collection, owner, document_id)
+        self.add(collection, request, on_success, lease)
+
+    def delete(self, collection, document_id, on_success=None, owner=None):
+        """
+        Buffer the deletion of the document with the id, only while owner holds its lease if given.
+        """
+        lease = None if owner is None else (collection, owner, document_id)
+        self.add(collection, DeleteOne(self.id_filter(document_id, owner)), on_success, lease)
+
+    def move(self, document, source, target, on_success=None, owner=None):
+        """
+        Buffer the transition of a document from the source collection to the target one.
+        The document is inserted into the target unless it is there already and, once that succeeded,
+        deleted from the source. With an owner, both steps only happen while it holds the lease in the source.
+        :param document: the document to write into the target, its _id identifies it in the source as well
+        :param source: pymongo collection the document leaves
+        :param target: pymongo collection the document enters
+        :param on_success: function without arguments called once the document left the source
+        :param owner: the lease owner the document is moved for, None to move it anyway
+        :return: None
+        """
+        lease = None if owner is None else (source, owner, document["_id"])
+
+        def delete_from_source():
+            self.delete(source, document["_id"], on_success, owner=owner)
+
+        # $setOnInsert, a retried move must not overwrite what the next owner of the document changed meanwhile
+        request = UpdateOne({"_id": document["_id"]}, {"$setOnInsert": document}, upsert=True)
+        self.add(target, request, on_success=delete_from_source, lease=lease)
+
+    def flush(self):
+        """
+        Send the buffered writes, and then the writes added meanwhile by their callbacks.
+        :return: number of failed writes
+        """
+        failed = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    pending, self._pending, self._oldest = self._pending, [], None
+                if not pending:
+                    return failed
+                failed += self._send(pending)
+
+    def _hold_leases(self, collection, owner, document_ids):
+        """
+        Renew the leases the owner still holds on the documents and return their ids.
+        Once renewed, no other listener can claim them before the writes of the flush land.
+        :return: set of the ids of the documents whose lease the owner holds
+        """
+        query = {"_id": {"$in": document_ids}, "lease_owner": owner}
+        collection.update_many(query, {"$set": {"lease_until": time.time() + self.lease_duration}})
+        return {document["_id"] for document in collection.find(query, projection={"_id": True})}
+
+    def _confirm_leases(self, pending):
+        """
+        Drop the writes with a callback whose lease was lost.
+        :param pending: list of (collection, request, on_success, lease) tuples
+        :return: tuple (writes to send, number of writes failed because the leases could not be checked)
+        """
+        leases = {}
+        for _, _, on_success, lease in pending:
+            if on_success is not None and lease is not None:
+                lease_collection, owner, document_id = lease
+                key = (lease_collection.full_name, owner)
+                leases.setdefault(key, (lease_collection, owner, []))[2].append(document_id)
+
+        held = {}
+        for key, (lease_collection, owner, document_ids) in leases.items():
+            try:
+                held[key] = self._hold_leases(lease_collection, owner, document_ids)
+            except PyMongoError:
+                self.logger.exception(f"Failed to check the leases of {owner} in {lease_collection.full_name}.")
+
+        to_send = []
+        failed = 0
+        for item in pending:
+            _, request, on_success, lease = item
+            if on_success is None or lease is None:
+                to_send.append(item)
+                continue
+            key = (lease[0].full_name, lease[1])
+            if key not in held:
+                failed += 1
+            elif lease[2] in held[key]:
+                to_send.append(item)
+            else:
+                self.logger.info(f"Dropping {request}, the lease on {lease[2]} was lost.")
+        return to_send, failed
+
+    @staticmethod
+    def _coalesce(items):
+        """
+        Merge the guarded deletions of the same owner into one DeleteMany, the other writes are kept as they are.
+        The leases of the ones carrying a callback were confirmed just before, so the DeleteMany removes each of them.
+        :param items: list of (collection, request, on_success, lease) tuples of a single collection
+        :return: list of (request, items) tuples, the items being the writes the request stands for
+        """
+        requests = []
+        deletes = {}
+        for item in items:
+            _, request, _, lease = item
+            if isinstance(request, DeleteOne) and lease is not None:
+                deletes.setdefault(lease[1], []).append(item)
+            else:
+                requests.append((request, [item]))
+        for owner, owner_items in deletes.items():
+            document_ids = [lease[2] for _, _, _, lease in owner_items]
+            request = DeleteMany({"_id": {"$in": document_ids}, "lease_owner": owner})
+            requests.append((request, owner_items))
+        return requests
+
+    def _send(self, pending):
+        """
+        Send the writes with a single unordered bulk_write per collection and call the callbacks of the successful ones.
+        :param pending: list of (collection, request, on_success, lease) tuples
+        :return: number of failed writes
+        """
+        pending, failed = self._confirm_leases(pending)
+        by_collection = {}
+        for item in pending:
+            by_collection.setdefault(item[0].full_name, []).append(item)
+
+        for full_name, items in by_collection.items():
+            collection = items[0][0]
+            requests = self._coalesce(items)
+            failed_indexes = set()
+            try:
+                collection.bulk_write([request for request, _ in requests], ordered=False)
+            except BulkWriteError as err:
+                for error in err.details.get("writeErrors", []):
+                    failed_indexes.add(error["index"])
+                    self.logger.error(f"Failed to write {error.get('op')} into {full_name}: {error.get('errmsg')}")
+                if err.details.get("writeConcernErrors"):
+                    # The writes may or may not have been applied, none of them is followed up
+                    self.logger.error(f"Write concern failed on {full_name}: {err.details['writeConcernErrors']}")
+                    failed_indexes = set(range(len(requests)))
+            except PyMongoError:
+                self.logger.exception(f"Failed to write {len(items)} requests into {full_name}.")
+                failed_indexes = set(range(len(requests)))
+
+            for index, (_, request_items) in enumerate(requests):
+                if index in failed_indexes:
+                    failed += len(request_items)
+                    continue
+                for _, _, on_success, _ in request_items:
+                    if on_success is None:
+                        continue
+                    try:
+                        on_success()
+                    except Exception:
+                        self.logger.exception(f"Failed to follow up a write into {full_name}.")
+        return failed
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+try:
+    import sys
+    import json
+    import time
+    import random
+    import hashlib
+    import argparse
+    import datetime
+    import threading
+    from collections import Counter, deque
+    from urllib.parse import urlsplit, parse_qs
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+FLIGHT_LIST_PATH = "/common/v1/flight/list.json"
+
+
+def parse_latency(spec):
+    """
+        Parse the latency distribution given on the command line.
+        Arguments:
+            spec: one of
+                fixed:SECONDS
+                uniform:LOW,HIGH
+                normal:MEAN,STDDEV
+                exponential:MEAN
+                lognormal:MU,SIGMA (of the underlying normal distribution)
+        Returns:
+            function (rng) -> number of seconds
+        Raise ValueError if the spec is invalid.
+    """
+    name, _, params = spec.partition(":")
+    try:
+        values = [float(value) for value in params.split(",")] if params else []
+    except ValueError:
+        raise ValueError(f"Invalid latency parameters: {spec}")
+
+    distributions = {
+        "fixed": (1, lambda rng, v: v[0]),
+        "uniform": (2, lambda rng, v: rng.uniform(v[0], v[1])),
+        "normal": (2, lambda rng, v: rng.gauss(v[0], v[1])),
+        "exponential": (1, lambda rng, v: rng.expovariate(1 / v[0]) if v[0] > 0 else 0),
+        "lognormal": (2, lambda rng, v: rng.lognormvariate(v[0], v[1])),
+    }
+    if name not in distributions:
+        raise ValueError(f"Unknown latency distribution: {name}")
+    num_params, sample = distributions[name]
+    if len(values) != num_params:
+        raise ValueError(f"{name} latency takes {num_params} parameters: {spec}")
+    return lambda rng: max(0.0, sample(rng, values))
+
+
+class FakeFlightradar:
+    """
+        Generates the synthetic flights and the responses of the flight list endpoint.
+        The flights of a flight code are derived from the seed and the flight code only,
+        so every request sees the same flight ids, while statuses move on with the wall clock.
+    """
+    def __init__(
+            self,
+            seed=0,
+            flights_per_code=60,
+            future_days=10,
+            latency=None,
+            error_rate=0.0,
+            throttle_rate=0.0,
+            max_rps=None,
+            retry_after=1):
+        """
+            Arguments:
+                seed: seed of the synthetic data
+                flights_per_code: number of daily flights in the history of every flight code
+                future_days: number of days the schedule reaches into the future
+                latency: function (rng) -> seconds, as returned by parse_latency. None for no latency
+                error_rate: fraction of requests answered with a 5xx error
+                throttle_rate: fraction of requests answered with 429
+                max_rps: answer with 429 once more requests than this arrive within a second, None for no limit
+                retry_after: value of the Retry-After header of the 429 responses
+        """
+        self.seed = seed
+        self.flights_per_code = flights_per_code
+        self.future_days = future_days
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.status_counts = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent_requests = deque()
+
+    def _flight_rng(self, flight_code, day):
+        digest = hashlib.sha1(f"{self.seed}:{flight_code}:{day.isoformat()}".encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def make_flight(self, flight_code, day, now):
+        """
+            Create the row of the flight code departing on the day, as returned by the real API.
+        """
+        code_rng = self._flight_rng(flight_code, datetime.date(2000, 1, 1))
+        departure_minute = code_rng.randrange(0, 24 * 60, 5)
+        duration = code_rng.randrange(45, 14 * 60, 5) * 60
+
+        rng = self._flight_rng(flight_code, day)
+        midnight = datetime.datetime(day.year, day.month, day.day)
+        scheduled_dep = int(midnight.timestamp()) + departure_minute * 60
+        scheduled_arr = scheduled_dep + duration
+        delay = int(max(0.0, rng.gauss(10, 20))) * 60
+        estimated_dep = scheduled_dep + delay
+        estimated_arr = scheduled_arr + delay + rng.randrange(-10, 11) * 60
+
+        real_dep = real_arr = None
+        if estimated_arr <= now:
+            real_dep, real_arr = estimated_dep, estimated_arr
+            estimated_dep = estimated_arr = None
+            status = f"Landed {time.strftime('%H:%M', time.localtime(real_arr))}"
+        elif estimated_dep <= now:
+            real_dep = estimated_dep
+            estimated_dep = None
+            status = f"Estimated- {time.strftime('%H:%M', time.localtime(estimated_arr))}"
+        elif estimated_dep - now < 24 * 3600:
+            status = "Scheduled" if delay == 0 else f"Delayed {time.strftime('%H:%M', time.localtime(estimated_dep))}"
+        else:
+            estimated_dep = estimated_arr = None
+            status = "Scheduled"
+
+        return {
+            "identification": {
+                "id": None,
+                "row": rng.randrange(10 ** 9, 10 ** 10),
+                "number": {"default": flight_code, "alternative": None},
+                "callsign": None,
+            },
+            "status": {"live": real_dep is not None and real_arr is None, "text": status},
+            "time": {
+                "scheduled": {"departure": scheduled_dep, "arrival": scheduled_arr},
+                "real": {"departure": real_dep, "arrival": real_arr},
+                "estimated": {"departure": estimated_dep, "arrival": estimated_arr},
+                "other": {"eta": None, "duration": None},
+            },
+        }
+
+    def flight_list(self, flight_code, page, limit):
+        """
+            Build the decoded json of the flight list endpoint, flights ordered from the latest to the earliest.
+        """
+        now = int(time.time())
+        last_day = datetime.date.today() + datetime.timedelta(days=self.future_days)
+        total = self.flights_per_code
+        start = (page - 1) * limit
+        days = [last_day - datetime.timedelta(days=i) for i in range(start, min(total, start + limit))]
+        data = [self.make_flight(flight_code, day, now) for day in days]
+        return {
+            "result": {
+                "request": {"query": flight_code, "page": page, "limit": limit, "fetchBy": "flight"},
+                "response": {
+                    "item": {"current": len(data), "total": total, "limit": limit},
+                    "page": {"current": page, "more": start + limit < total},
+                    "timestamp": now,
+                    "data": data or None,
+                },
+            },
+        }
+
+    def pick_fault(self):
+        """
+            Decide whether the current request fails.
+            Returns:
+                None for a successful request, otherwise the status code to answer with
+        """
+        with self._lock:
+            if self.max_rps is not None:
+                now = time.monotonic()
+                while self._recent_requests and now - self._recent_requests[0] > 1:
+                    self._recent_requests.popleft()
+                self._recent_requests.append(now)
+                if len(self._recent_requests) > self.max_rps:
+                    return 429
+            roll = self._rng.random()
+            if roll < self.throttle_rate:
+                return 429
+            if roll < self.throttle_rate + self.error_rate:
+                return self._rng.choice([500, 502, 503])
+        return None
+
+    def count(self, status):
+        with self._lock:
+            self.status_counts[status] += 1
+
+    def sleep(self):
+        if self.latency is not None:
+            with self._lock:
+                duration = self.latency(self._rng)
+            time.sleep(duration)
+
+
+class FakeFlightradarHandler(BaseHTTPRequestHandler):
+    """
+        Serves the flight list endpoint of the FakeFlightradar of the server, and the request counters on /stats.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.fake.count(status)
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        if url.path == "/stats":
+            with fake._lock:
+                counts = {str(status): count for status, count in fake.status_counts.items()}
+            self.send_json(200, counts)
+            return
+        if url.path != FLIGHT_LIST_PATH:
+            self.send_json(404, {"errors": {"message": "Not found"}})
+            return
+
+        fake.sleep()
+        fault = fake.pick_fault()
+        if fault == 429:
+            self.send_json(429, {"errors": {"message": "Too many requests"}}, {"Retry-After": str(fake.retry_after)})
+            return
+        if fault is not None:
+            self.send_json(fault, {"errors": {"message": "Server error"}})
+            return
+
+        query = parse_qs(url.query)
+        try:
+            flight_code = query["query"][0].upper()
+            page = max(1, int(query.get("page", ["1"])[0]))
+            limit = min(100, max(1, int(query.get("limit", ["100"])[0])))
+        except (KeyError, ValueError):
+            self.send_json(400, {"errors": {"message": "Invalid query"}})
+            return
+        self.send_json(200, fake.flight_list(flight_code, page, limit))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(fake, host="127.0.0.1", port=8024, verbose=False):
+    """
+        Create the HTTP server of the fake, call serve_forever() on it to start serving.
+        Arguments:
+            fake: FakeFlightradar instance
+            host: interface to listen on
+            port: port to listen on, 0 to pick a free one
+            verbose: log every request to stderr
+        Returns:
+            server: ThreadingHTTPServer, APIClient should use http://host:port/common/v1 as api_url
+    """
+    server = ThreadingHTTPServer((host, port), FakeFlightradarHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in of the flightradar24 flight list API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--flights-per-code", type=int, default=60, help="daily flights in the history of a code")
+    parser.add_argument("--future-days", type=int, default=10)
+    parser.add_argument("--latency", default=None, help="e.g. fixed:0.2, uniform:0.05,0.5, lognormal:-1.5,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 5xx responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--max-rps", type=float, default=None, help="answer 429 above this many requests a second")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    try:
+        latency = parse_latency(args.latency) if args.latency else None
+    except ValueError as err:
+        parser.error(str(err))
+
+    fake = FakeFlightradar(
+        seed=args.seed,
+        flights_per_code=args.flights_per_code,
+        future_days=args.future_days,
+        latency=latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        max_rps=args.max_rps,
+        retry_after=args.retry_after,
+    )
+    server = make_server(fake, host=args.host, port=args.port, verbose=args.verbose)
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port}, set FR24_API_URL=http://{host}:{port}/common/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,20 +2,25 @@ from threading import Thread
 
 try:
     from pprint import pprint
-    import concurrent.futures
+    import asyncio
+    import functools
     from concurrent.futures import ThreadPoolExecutor
     import time
     import datetime
     from multiprocessing import Process
 
     from pymongo.errors import PyMongoError
-    from pymongo import UpdateOne
-    from pymongo.collection import Collection
+    from pymongo import ASCENDING
     from telegram.utils.request import Request
     from telegram import Bot
 
     import config
-    from helpers import get_collection, get_logger, Flight, APIClient, Alert
+    from helpers import (
+        get_collection, get_logger, APIClient, Alert, FlightLookupCoalescer, compute_promote_at,
+        make_lease_owner, claim_filter, claim_alerts, iter_claims, run_bounded, LEASE_UNSET,
+    )
+    from async_api_client import AsyncAPIClient, AsyncFlightLookupCoalescer
+    from bulk_write_buffer import BulkWriteBuffer
 
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
@@ -28,7 +33,6 @@ class FrozenListener(Thread):
         This object is to check the frozen queue in the DB, and if any update, process it.
         """
         super().__init__()
-        self._futures = None
         self._logger = get_logger(
             logger_name="FROZEN_LISTENER",
             file_name=config.FROZEN_LISTENER_LOG_PATH,
@@ -60,61 +64,225 @@ class FrozenListener(Thread):
             logger_name="FROZEN_API_CLIENT",
             logger_path=config.FROZEN_API_CLIENT_LOG_PATH,
         )
+        self.async_api_client = AsyncAPIClient(
+            logger_name="FROZEN_ASYNC_API_CLIENT",
+            logger_path=config.FROZEN_ASYNC_API_CLIENT_LOG_PATH,
+        )
+        self.lease_owner = make_lease_owner("FROZEN_LISTENER")
+        self.write_buffer = BulkWriteBuffer(self._logger)
 
         self._logger.info("FrozenListener created")
 
-    def listen_to_queue(self):
-        alerts = self.frozen_collection.find({})
+    @staticmethod
+    def due_filter(now):
+        """
+        Return the filter of the alerts due for promotion at now.
+        Alerts frozen before promote_at was introduced have none and are checked right away, which sets it.
+        """
+        return {"$or": [{"promote_at": {"$lte": now}}, {"promote_at": None}]}
+
+    def count_due_alerts(self):
+        """
+        Return the number of alerts due for promotion, including the ones claimed by other listeners.
+        """
         try:
-            num_alerts = self.frozen_collection.count_documents({})
+            return self.frozen_collection.count_documents(self.due_filter(datetime.datetime.today()))
         except PyMongoError:
             self._logger.exception("Failed to get info from the DB.")
             raise RuntimeError("Failed to get info from the DB.")
 
-        self._logger.info(f"Found {num_alerts} alerts in the frozen queue, starting to process.")
-        futures = [self.thread_pool.submit(self.process_alert, alert) for alert in alerts]
-        # for debugging purposes
-        self._futures = futures
-        for future in concurrent.futures.as_completed(futures, timeout=40):
-            if future.done():
-                self._logger.info(f"Done with the current one: {future}.")
+    def claim_batch(self):
+        """
+        Claim the next LEASE_BATCH_SIZE alerts due for promotion, the earliest first.
+        """
+        return claim_alerts(
+            self.frozen_collection,
+            self.due_filter(datetime.datetime.today()),
+            self.lease_owner,
+            config.LEASE_BATCH_SIZE,
+            sort=[("promote_at", ASCENDING)],
+        )
+
+    def seconds_until_next_promotion(self):
+        """
+        Return the number of seconds until the earliest alert is due for promotion,
+        within FROZEN_LISTENER_MIN_SLEEP_DURATION and FROZEN_LISTENER_SLEEP_DURATION.
+        The alerts leased by a sweep are left out, they are decided by it or claimed again once the lease expires.
+        """
+        try:
+            earliest = self.frozen_collection.find_one(
+                claim_filter({}, time.time()),
+                projection={"promote_at": True},
+                sort=[("promote_at", ASCENDING)],
+            )
+        except PyMongoError:
+            self._logger.exception("Failed to get the next due alert.")
+            return config.FROZEN_LISTENER_SLEEP_DURATION
+        if earliest is None:
+            return config.FROZEN_LISTENER_SLEEP_DURATION
+        promote_at = earliest.get("promote_at")
+        wait = 0 if promote_at is None else (promote_at - datetime.datetime.today()).total_seconds()
+        return min(config.FROZEN_LISTENER_SLEEP_DURATION, max(config.FROZEN_LISTENER_MIN_SLEEP_DURATION, wait))
+
+    def iter_claimed_alerts(self):
+        """
+        Claim the alerts due for promotion a window of FROZEN_LISTENER_MAX_IN_FLIGHT at a time as the sweep
+        consumes them, the earliest first.
+        """
+        return iter_claims(
+            self.frozen_collection,
+            self.due_filter(datetime.datetime.today()),
+            self.lease_owner,
+            config.FROZEN_LISTENER_MAX_IN_FLIGHT,
+            sort=[("promote_at", ASCENDING)],
+        )
+
+    def listen_to_queue(self):
+        num_alerts = self.count_due_alerts()
+        self._logger.info(f"Found {num_alerts} due alerts in the frozen queue, starting to process.")
+        # Every distinct flight code is requested once per sweep and shared between its alerts
+        flight_lookup = FlightLookupCoalescer(self.api_client)
+        deadline = time.time() + config.FROZEN_LISTENER_SWEEP_DEADLINE
+        futures = run_bounded(
+            self.thread_pool,
+            functools.partial(self.process_alert, flight_lookup=flight_lookup),
+            self.iter_claimed_alerts(),
+            config.FROZEN_LISTENER_MAX_IN_FLIGHT,
+            deadline=deadline,
+        )
+        for future in futures:
+            if future.exception() is not None:
+                self._logger.error(f"Failed to process an alert: {future.exception()!r}")
+            else:
+                self.promote(*future.result())
+        self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def listen_to_queue_async(self):
+        """
+        The asyncio flavour of listen_to_queue. The flight lookups run on the event loop, at most
+        FROZEN_LISTENER_ASYNC_CONCURRENCY at a time, the rest of the processing runs in the thread pool.
+        """
+        num_alerts = self.count_due_alerts()
+        self._logger.info(f"Found {num_alerts} due alerts in the frozen queue, starting to process asynchronously.")
+        flight_lookup = AsyncFlightLookupCoalescer(self.api_client, self.async_api_client)
+        semaphore = asyncio.Semaphore(config.FROZEN_LISTENER_ASYNC_CONCURRENCY)
+        deadline = time.time() + config.FROZEN_LISTENER_SWEEP_DEADLINE
+        try:
+            while time.time() < deadline:
+                batch = self.claim_batch()
+                if not batch:
+                    break
+                results = await asyncio.gather(
+                    *[self.process_alert_async(alert, flight_lookup, semaphore) for alert in batch],
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        self._logger.error(f"Failed to process an alert: {result!r}")
+                    else:
+                        self.promote(*result)
+        finally:
+            await self.async_api_client.close()
+            self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def process_alert_async(self, alert_dict, flight_lookup, semaphore):
+        """
+        Prefetch the flight of the alert on the event loop, then process the alert in the thread pool.
+        Arguments:
+            :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: the AsyncFlightLookupCoalescer of the sweep
+            :param semaphore: asyncio.Semaphore limiting the number of lookups in flight
+        Returns:
+            the outcome returned by process_alert
+        """
+        if compute_promote_at(alert_dict['date']) <= datetime.datetime.today():
+            async with semaphore:
+                await flight_lookup.prefetch(alert_dict['flight_code'])
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.thread_pool, self.process_alert, alert_dict, flight_lookup)
 
     def run(self):
         while True:
             self._logger.info("Starting to listen...")
-            self.listen_to_queue()
-            time.sleep(config.FROZEN_LISTENER_SLEEP_DURATION)
+            if config.FROZEN_LISTENER_USE_ASYNC:
+                asyncio.run(self.listen_to_queue_async())
+            else:
+                self.listen_to_queue()
+            time.sleep(self.seconds_until_next_promotion())
 
-    def update_one(self, document: dict, collection: Collection):
-        try:
-            update_result = collection.update_one(
-                {"_id": document["_id"]},
-                {"$set": document},
-                upsert=True,
+    def log_api_client_stats(self):
+        if self.api_client.cache is not None:
+            self._logger.info(f"Response cache stats: {self.api_client.cache.stats()}")
+        if self.api_client.proxy_pool is not None:
+            self._logger.info(f"Proxy pool stats: {self.api_client.proxy_pool.stats()}")
+
+    def promote(self, alert_dict, document, reply):
+        """
+        Apply the outcome of process_alert through the write buffer: move the promoted alert into active,
+        remove the other decided alerts from frozen, and inform the user once that succeeded.
+        An alert whose write fails stays in frozen, its lease expires and it is claimed again.
+        Arguments:
+            :param alert_dict: the alert from the frozen queue
+            :param document: the alert to insert into active, None if there is none
+            :param reply: the message to the user, None to leave the alert in frozen
+        Returns:
+            None
+        """
+        if reply is None:
+            return
+        inform_user = functools.partial(self.bot.send_message, chat_id=alert_dict['chat_id'], text=reply)
+        if document is not None:
+            self._logger.info(f"Moving {alert_dict['_id']} from frozen queue into active")
+            self.write_buffer.move(
+                document,
+                self.frozen_collection,
+                self.active_collection,
+                on_success=inform_user,
+                owner=self.lease_owner,
             )
-        except PyMongoError:
-            self._logger.exception("Failed to insert into collection.")
-            raise RuntimeError("Failed to insert into collection.")
         else:
-            return update_result
+            self._logger.info(f"Removing {alert_dict['_id']} from frozen queue")
+            self.write_buffer.delete(
+                self.frozen_collection, alert_dict['_id'], on_success=inform_user, owner=self.lease_owner
+            )
 
-    def process_alert(self, alert_dict):
+    def process_alert(self, alert_dict, flight_lookup=None):
         """
-        Process the alert from the frozen queue, if valid, send to active and remove from frozen
+        Process the alert from the frozen queue and decide whether to promote it to active.
+        The writes are left to promote.
         Arguments:
             :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: object used to look the flight up, the APIClient or the sweep's
+                FlightLookupCoalescer. Defaults to None, in which case self.api_client is used.
         Returns:
-            None
+            tuple (alert_dict, active_document, reply). active_document is the alert to insert into active,
+            None if there is none. reply is the message to the user, None to leave the alert in frozen.
         """
         self._logger.info(f"Checking the alert {alert_dict['_id']}")
         reply = None
-        if alert_dict['date'] - datetime.timedelta(days=9) > datetime.datetime.today():
+        document = None
+        if flight_lookup is None:
+            flight_lookup = self.api_client
+        promote_at = compute_promote_at(alert_dict['date'])
+        if promote_at > datetime.datetime.today():
             self._logger.info("Flight date is too far from today, leaving in frozen")
+            self.write_buffer.update(
+                self.frozen_collection,
+                alert_dict['_id'],
+                {"$set": {"promote_at": promote_at}, "$unset": LEASE_UNSET},
+                owner=self.lease_owner,
+            )
 
         # The case when the alert date is within accessible range
         else:
             try:
-                flight = self.api_client.get_flight_by_date(alert_dict['flight_code'], alert_dict['date'])
+                flight = flight_lookup.get_flight_by_date(alert_dict['flight_code'], alert_dict['date'])
             except ValueError:
                 self._logger.exception("No results found at all")
                 reply = f"I could not find flight {alert_dict['flight_code']}"
@@ -123,24 +291,16 @@ class FrozenListener(Thread):
                 if flight is None:
                     reply = f"Sorry I did not find {alert_dict['flight_code']}"
                     reply += f" on {alert_dict['date'].strftime('%d/%m/%Y')}."
-                elif flight.properties["Real Arrival"] is not None:
+                elif flight.real_arrival is not None:
                     self._logger.info("This flight has already arrived.")
                     reply = f"- - Your flight has already arrived - -\n"
                     reply += str(flight)
-                elif flight.properties['Current Status'] == "Unknown":
+                elif flight.status == "Unknown":
                     self._logger.warning("Current status is missing.")
                     reply = f"Hmm, looks like I don't have info about your {flight.flight_code} flight."
                 else:
                     self._logger.info("Flight found, processing it.")
                     alert = Alert(flight=flight, chat_id=alert_dict['chat_id'], alert_id=alert_dict["_id"])
                     reply = str(alert.flight)
-
-                    self._logger.info(f"Inserting {alert_dict['_id']} into active")
-                    self.update_one(alert.to_dict(), self.active_collection)
-        if reply is not None:
-            self.bot.send_message(
-                chat_id=alert_dict['chat_id'],
-                text=reply,
-            )
-            self._logger.info(f"Removing {alert_dict['_id']} from frozen queue")
-            self.frozen_collection.delete_one({"_id": alert_dict['_id']})
+                    document = alert.to_dict()
+        return alert_dict, document, reply
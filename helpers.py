@@ -1,20 +1,43 @@
 try:
     import re
+    import json
+    import hashlib
+    import time
+    import operator
     import datetime
+    import os
     import logging
+    import uuid
+    import socket
+    import threading
+    from typing import Optional
+    from concurrent.futures import Future, wait, FIRST_COMPLETED
+
     import requests
+    from requests.adapters import HTTPAdapter
 
-    from pymongo import MongoClient, UpdateOne
+    from pymongo import MongoClient
     from pymongo.collection import Collection
     from pymongo.errors import PyMongoError
     from telegram import Bot
 
     import config
+    from response_cache import get_response_cache
+    from rate_limiter import get_rate_limiter, parse_retry_after
+    from proxy_pool import get_proxy_pool
+    from api_recorder import get_recorder, get_replayer
+    from airline_designators import AirlineDesignatorIndex
 
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
     \nPlease install all necessary libraries and try again')
 
+# orjson is optional, it only makes decoding the API responses faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def get_logger(
         logger_name=__name__, 
@@ -51,20 +74,65 @@ def get_logger(
     return logger
 
 
+def decode_json(content):
+    """
+    Decode the JSON document with orjson if it is installed and enabled in the config, with json otherwise.
+
+    Arguments:
+        content: bytes or str of the document
+    Return:
+        the decoded document
+    """
+    if orjson is not None and config.API_USE_ORJSON:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(connection_uri: str) -> MongoClient:
+    """
+    Return the MongoClient of the current process for the connection uri, creating it on first use.
+    Every client keeps its own connection pool and monitoring threads, so all the collections share one per uri.
+    The clients are kept per process id, so a process forked after its parent connected gets a client of its own,
+    as long as it resolves its collections after the fork rather than keeping the ones of its parent.
+    """
+    key = (os.getpid(), connection_uri)
+    with _mongo_clients_lock:
+        client = _mongo_clients.get(key)
+        if client is None:
+            client = MongoClient(
+                connection_uri,
+                maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=config.MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=config.MONGO_MAX_IDLE_TIME_MS,
+                connect=False,
+            )
+            _mongo_clients[key] = client
+    return client
+
+
 def get_collection(connection_uri: str, db_name: str, collection_name: str) -> Collection:
-    client = MongoClient(connection_uri)
+    client = get_mongo_client(connection_uri)
     db = client.get_database(name=db_name)
     coll = db.get_collection(collection_name)
     return coll
 
 
-def process_flight_code(flight_code: str, airline_designator_collection: Collection) -> dict:
+def process_flight_code(
+        flight_code: str,
+        airline_designator_collection: Optional[Collection] = None,
+        airline_designator_index: Optional[AirlineDesignatorIndex] = None) -> dict:
     """
         Take in the flight code and try to identify IATA, ICAO and flight num.
 
         Arguments:
             flight_code: string provided by the user
             airline_designator_collection: pymongo collection object where airline designators are stored
+            airline_designator_index: AirlineDesignatorIndex to look the designators up in memory.
+                The collection is queried only if the index is not given or not loaded.
         Returns:
             data: dictionary of the parse data if any
         Raise ValueError if invalid input
@@ -82,29 +150,29 @@ def process_flight_code(flight_code: str, airline_designator_collection: Collect
         data['iata'] = None
         data['icao'] = airline_code
 
-    if data['iata'] is None:
-        airlines = airline_designator_collection.find(
-            {
-                "icao": data['icao'],
-            }
-        )
+    if airline_designator_index is not None and len(airline_designator_index):
+        if data['iata'] is None:
+            iata = airline_designator_index.iata_for_icao(data['icao'])
+        else:
+            airline = airline_designator_index.by_iata(data['iata'])
+            iata = None if airline is None else airline['iata']
     else:
-        airlines = airline_designator_collection.find(
-            {
-                "iata": data['iata'],
-            }
-        )
-    try:
-        airlines = list(airlines)
-    except PyMongoError:
-        reply = "There was an error, please try again later."
-        raise ValueError(reply)
+        if data['iata'] is None:
+            query = {"icao": data['icao']}
+        else:
+            query = {"iata": data['iata']}
+        try:
+            airline = airline_designator_collection.find_one(query, projection={"iata": True})
+        except PyMongoError:
+            reply = "There was an error, please try again later."
+            raise ValueError(reply)
+        iata = None if airline is None else airline.get('iata')
 
-    if len(airlines) == 0:
+    # Airlines without an IATA code can not be looked up on flightradar24 either
+    if iata is None:
         reply = "Hmm, I cant find the flight info you asked for :/"
         raise ValueError(reply)
-    else:
-        data['iata'] = airlines[0]['iata']
+    data['iata'] = iata
     data['flight_code'] = data['iata'] + data['flight_number']
     return data
 
@@ -183,44 +251,319 @@ def validate_queue_and_inform_user(
     )
 
 
+# The fields of the lease a listener holds on an alert, see claim_alerts
+LEASE_FIELDS = ("lease_owner", "lease_until")
+LEASE_UNSET = {field: "" for field in LEASE_FIELDS}
+
+
+def make_lease_owner(name: str) -> str:
+    """
+    Return a lease owner id unique to this listener instance across hosts and restarts.
+    :param name: the name of the listener
+    """
+    return f"{socket.gethostname()}:{name}:{uuid.uuid4().hex[:12]}"
+
+
+def claim_filter(query: dict, now: float) -> dict:
+    """
+    Return the filter of the alerts matching the query which nobody holds an unexpired lease on at now.
+    """
+    return {"$and": [query, {"$or": [{"lease_until": {"$lte": now}}, {"lease_until": None}]}]}
+
+
+def claim_alerts(
+        collection: Collection,
+        query: dict,
+        owner: str,
+        limit: int,
+        lease_duration=config.LEASE_DURATION,
+        sort=None) -> list:
+    """
+    Claim up to limit alerts matching the query which nobody else holds a lease on.
+    The candidates are read first, then leased with a single update_many which only matches the ones still free,
+    so listeners running side by side never claim the same alert. The alerts carrying this very lease are read
+    back, the candidates taken by another listener meanwhile are replaced in the next round.
+    Expired leases, left behind by crashed listeners, are claimed like free alerts.
+    Arguments:
+        collection: pymongo collection of the alerts
+        query: filter of the alerts to claim
+        owner: id of the claiming listener, as returned by make_lease_owner
+        limit: maximum number of alerts to claim
+        lease_duration: number of seconds the lease is held
+        sort: order in which the alerts are claimed, a list of (key, direction) pairs
+    Returns:
+        list of the claimed alerts
+    Raise RuntimeError if the DB fails.
+    """
+    claimed = []
+    while len(claimed) < limit:
+        now = time.time()
+        try:
+            candidates = collection.find(
+                claim_filter(query, now), projection={"_id": True}, sort=sort, limit=limit - len(claimed)
+            )
+            ids = [candidate["_id"] for candidate in candidates]
+            if not ids:
+                break
+            # The lease_until of this round tells its claims apart from the older ones of the same owner
+            lease = {"lease_owner": owner, "lease_until": now + lease_duration}
+            collection.update_many(claim_filter({"_id": {"$in": ids}}, now), {"$set": lease})
+            claimed.extend(collection.find({"_id": {"$in": ids}, **lease}, sort=sort))
+        except PyMongoError:
+            raise RuntimeError("Failed to claim alerts.")
+    return claimed
+
+
+def release_alerts(collection: Collection, owner: str, alert_ids: list):
+    """
+    Release the leases the owner holds on the alerts, so other listeners can claim them right away.
+    Raise RuntimeError if the DB fails.
+    """
+    try:
+        collection.update_many({"_id": {"$in": alert_ids}, "lease_owner": owner}, {"$unset": LEASE_UNSET})
+    except PyMongoError:
+        raise RuntimeError("Failed to release alerts.")
+
+
+def iter_claims(
+        collection: Collection,
+        query: dict,
+        owner: str,
+        batch_size: int,
+        lease_duration=config.LEASE_DURATION,
+        sort=None):
+    """
+    Claim the alerts matching the query batch_size at a time, as they are consumed. See claim_alerts for the arguments.
+    The next batch is claimed once the previous one is handed out, so at most batch_size alerts are held ahead of
+    the consumer. The claims not handed out yet are released when the generator is closed.
+    """
+    batch = []
+    try:
+        while True:
+            batch = claim_alerts(collection, query, owner, batch_size, lease_duration=lease_duration, sort=sort)
+            if not batch:
+                return
+            while batch:
+                yield batch.pop(0)
+    finally:
+        if batch:
+            release_alerts(collection, owner, [alert["_id"] for alert in batch])
+
+
+def run_bounded(executor, func, items, max_in_flight: int, deadline: Optional[float] = None):
+    """
+    Call func on every item in the executor, with at most max_in_flight calls submitted and not finished.
+    The items are pulled from the iterable only when there is room, so a cursor is streamed and never loaded whole.
+    Once the deadline passes no more items are pulled, the calls already submitted are still waited for.
+    The iterable is closed once no more items are pulled from it.
+    Arguments:
+        executor: concurrent.futures executor running the calls
+        func: function taking a single item
+        items: iterable of the items
+        max_in_flight: maximum number of submitted and not finished calls
+        deadline: unix time after which no more items are pulled, None for no deadline
+    Yields:
+        the futures of the calls, in the order they finish
+    """
+    items = iter(items)
+    in_flight = set()
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < max_in_flight:
+            if deadline is not None and time.time() >= deadline:
+                exhausted = True
+                break
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight.add(executor.submit(func, item))
+        if exhausted and hasattr(items, "close"):
+            # Lets a generator of claimed items release the ones it holds ahead
+            items.close()
+        if not in_flight:
+            return
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        yield from done
+
+
+def strip_lease(alert_dict: dict) -> dict:
+    """
+    Return a copy of the alert without the lease fields, to be written into another collection.
+    """
+    return {key: value for key, value in alert_dict.items() if key not in LEASE_FIELDS}
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def create_http_session(
+        pool_connections=config.API_POOL_CONNECTIONS,
+        pool_maxsize=config.API_POOL_MAXSIZE,
+        pool_block=config.API_POOL_BLOCK) -> requests.Session:
+    """
+    Create a keep-alive session with a connection pool mounted for http and https.
+
+    Arguments:
+        pool_connections: number of per-host connection pools to keep
+        pool_maxsize: maximum number of connections kept open to a single host
+        pool_block: if True, wait for a free connection instead of exceeding pool_maxsize per host
+    Return:
+        session: the created requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """
+    Return the session shared by everything in the current process, creating it on first use.
+    Sessions are kept per process id, so a forked listener never reuses the sockets of its parent.
+    """
+    pid = os.getpid()
+    with _http_sessions_lock:
+        session = _http_sessions.get(pid)
+        if session is None:
+            session = create_http_session()
+            _http_sessions[pid] = session
+    return session
+
+
+def to_epoch(value) -> Optional[int]:
+    """
+    Convert a timestamp or a naive local datetime to epoch seconds, keep None as is.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def flight_fingerprint(values) -> str:
+    """
+    Return a stable hash of the tracked values of a flight, equal across processes and restarts.
+    :param values: tuple of the values of Flight.FIELDS, in the same order
+    :return: hex digest
+    """
+    return hashlib.blake2b(repr(tuple(values)).encode(), digest_size=8).hexdigest()
+
+
 class Flight:
     """
-    Class representing a flight
+    Class representing a flight.
+    The properties live in fixed slots in the order of FIELDS, the times are epoch seconds or None.
     """
-    def __init__(self, flight_id, flight_code, properties_dict):
+    FIELDS = (
+        "status",
+        "scheduled_departure",
+        "real_departure",
+        "estimated_departure",
+        "scheduled_arrival",
+        "real_arrival",
+        "estimated_arrival",
+    )
+    # Human readable names of FIELDS, in the same order
+    FIELD_LABELS = (
+        "Current Status",
+        "Scheduled Departure",
+        "Real Departure",
+        "Estimated Departure",
+        "Scheduled Arrival",
+        "Real Arrival",
+        "Estimated Arrival",
+    )
+    __slots__ = ("flight_id", "flight_code") + FIELDS
+    # Returns the values of FIELDS as a tuple
+    _field_values = operator.attrgetter(*FIELDS)
+
+    def __init__(
+            self,
+            flight_id: int,
+            flight_code: str,
+            status: Optional[str] = None,
+            scheduled_departure: Optional[int] = None,
+            real_departure: Optional[int] = None,
+            estimated_departure: Optional[int] = None,
+            scheduled_arrival: Optional[int] = None,
+            real_arrival: Optional[int] = None,
+            estimated_arrival: Optional[int] = None):
         """
         Constructor of the flight
         :param flight_id: flight ID given by flightradar24 API
         :param flight_code: flight code comprised of airline code and flight number
-        :param properties_dict: a dictionary containing all available info about the flight
+        :param status: the current status text of the flight
+        :param scheduled_departure: the rest of the arguments are epoch seconds, None if unknown
         """
         self.flight_id = flight_id
         self.flight_code = flight_code
-        self.properties = properties_dict.copy()
+        self.status = status
+        self.scheduled_departure = scheduled_departure
+        self.real_departure = real_departure
+        self.estimated_departure = estimated_departure
+        self.scheduled_arrival = scheduled_arrival
+        self.real_arrival = real_arrival
+        self.estimated_arrival = estimated_arrival
 
     @classmethod
     def from_dict(cls, flight_dict):
         """
         Alternative constructor to create the instance from dictionary
-        :param flight_dict:
+        Dictionaries of the older format, with a 'properties' dictionary of datetime objects, are supported as well.
+        :param flight_dict: dictionary created by to_dict
         :return: instance of Flight with properties taken from flight_dict
         """
-        flight_id = flight_dict['flight_id']
-        flight_code = flight_dict['flight_code']
-        properties = flight_dict['properties']
-        return cls(flight_id=flight_id, flight_code=flight_code, properties_dict=properties)
+        if 'properties' in flight_dict:
+            properties = flight_dict['properties']
+            return cls(
+                flight_dict['flight_id'],
+                flight_dict['flight_code'],
+                properties.get("Current Status"),
+                to_epoch(properties.get("Scheduled Departure")),
+                to_epoch(properties.get("Real Departure")),
+                to_epoch(properties.get("Estimated Departure")),
+                to_epoch(properties.get("Scheduled Arrival")),
+                to_epoch(properties.get("Real Arrival")),
+                to_epoch(properties.get("Estimated Arrival")),
+            )
+        return cls(
+            flight_dict['flight_id'],
+            flight_dict['flight_code'],
+            flight_dict.get('status'),
+            flight_dict.get('scheduled_departure'),
+            flight_dict.get('real_departure'),
+            flight_dict.get('estimated_departure'),
+            flight_dict.get('scheduled_arrival'),
+            flight_dict.get('real_arrival'),
+            flight_dict.get('estimated_arrival'),
+        )
 
     def to_dict(self):
         """
         Create and return the dictionary with all information about the flight
         :return: dictionary with all the information needed
         """
-        flight_dict = {
+        return {
             'flight_id': self.flight_id,
             'flight_code': self.flight_code,
-            'properties': self.properties,
+            'status': self.status,
+            'scheduled_departure': self.scheduled_departure,
+            'real_departure': self.real_departure,
+            'estimated_departure': self.estimated_departure,
+            'scheduled_arrival': self.scheduled_arrival,
+            'real_arrival': self.real_arrival,
+            'estimated_arrival': self.estimated_arrival,
+            'fingerprint': self.fingerprint(),
         }
-        return flight_dict
 
     @classmethod
     def create_from_api_response(cls, flight_dict):
@@ -233,80 +576,51 @@ class Flight:
         """
         try:
             flight_id = flight_dict['identification']['row']
-        except KeyError:
+        except (KeyError, TypeError):
             raise ValueError("No identification in the json file.")
 
         try:
             flight_code = flight_dict['identification']['number']['default']
-        except KeyError:
+        except (KeyError, TypeError):
             raise ValueError("No flight code in the json file.")
 
-        try:
-            curr_status = flight_dict['status']['text']
-        except KeyError:
-            curr_status = None
-
-        try:
-            scheduled_dep = datetime.datetime.fromtimestamp(flight_dict['time']['scheduled']['departure'])
-        except TypeError:
-            scheduled_dep = None
-        except KeyError:
-            scheduled_dep = None
-
-        try:
-            scheduled_arr = datetime.datetime.fromtimestamp(flight_dict['time']['scheduled']['arrival'])
-        except TypeError:
-            scheduled_arr = None
-        except KeyError:
-            scheduled_arr = None
-
-        try:
-            real_dep = datetime.datetime.fromtimestamp(flight_dict['time']['real']['departure'])
-        except TypeError:
-            real_dep = None
-        except KeyError:
-            real_dep = None
-
-        try:
-            real_arr = datetime.datetime.fromtimestamp(flight_dict['time']['real']['arrival'])
-        except TypeError:
-            real_arr = None
-        except KeyError:
-            real_arr = None
+        return cls(flight_id, flight_code, *cls.values_from_api_response(flight_dict))
 
-        try:
-            estimated_dep = datetime.datetime.fromtimestamp(flight_dict['time']['estimated']['departure'])
-        except TypeError:
-            estimated_dep = None
-        except KeyError:
-            estimated_dep = None
+    @staticmethod
+    def values_from_api_response(flight_dict):
+        """
+        Extract the values of FIELDS from a single flight of the flightradar24 API response.
+        :param flight_dict: a dictionary containing information about a single flight
+        :return: tuple of the values in the order of FIELDS
+        """
+        status = flight_dict.get('status') or {}
+        times = flight_dict.get('time') or {}
+        scheduled = times.get('scheduled') or {}
+        real = times.get('real') or {}
+        estimated = times.get('estimated') or {}
+        return (
+            status.get('text'),
+            to_epoch(scheduled.get('departure')),
+            to_epoch(real.get('departure')),
+            to_epoch(estimated.get('departure')),
+            to_epoch(scheduled.get('arrival')),
+            to_epoch(real.get('arrival')),
+            to_epoch(estimated.get('arrival')),
+        )
 
-        try:
-            estimated_arr = datetime.datetime.fromtimestamp(flight_dict['time']['estimated']['arrival'])
-        except TypeError:
-            estimated_arr = None
-        except KeyError:
-            estimated_arr = None
-
-        properties_dict = {
-            "Current Status": curr_status,
-            "Scheduled Departure": scheduled_dep,
-            "Real Departure": real_dep,
-            "Estimated Departure": estimated_dep,
-            "Scheduled Arrival": scheduled_arr,
-            "Real Arrival": real_arr,
-            "Estimated Arrival": estimated_arr,
-        }
-        flight = cls(flight_id=flight_id, flight_code=flight_code, properties_dict=properties_dict)
-        return flight
+    def fingerprint(self):
+        """
+        Return the hash of the tracked fields, see flight_fingerprint.
+        Two flights with equal fingerprints have no differences for compare to report.
+        """
+        return flight_fingerprint(self._field_values(self))
 
     def _validate_other(self, other):
         """
         A helper function to check if other is a valid Flight or not.
         A flight is considered valid, if
             1. it is an instance of the class Flight,
-            2. the list of properties the other and self have are the same
-            3. the flight_id and flight_code are equal for self and other.
+            2. the flight_id and flight_code are equal for self and other.
         :param other: an instance of Flight
         :return: None
         Raise TypeError if other is not an instance of Flight and ValueError if it is not valid for any other reason.
@@ -314,33 +628,25 @@ class Flight:
         if not isinstance(other, Flight):
             raise TypeError("Other should be an instance of Flight class.")
 
-        if self.properties.keys() != other.properties.keys():
-            raise ValueError("Properties of self and other did not match.")
-
-        if self.flight_id != other.flight_id or self.flight_code != self.flight_code:
+        if self.flight_id != other.flight_id or self.flight_code != other.flight_code:
             raise ValueError("Self and other are different flights!")
 
-        # This part of the code is likely to be useless as we have None for missing dates. When they appear, the types
-        # will differ, which is not good for us.
-        # for prop_name, prop in self.properties.items():
-        #     other_prop = other.properties[prop_name]
-        #     if type(other_prop) != type(prop):
-        #         raise ValueError(f"The type of the {prop_name} is different for self and other.")
-
     def compare(self, other):
         """
         Validate and compare the self and other. Return a dictionary of the differences of the following form:
-            {"property_name": [self_value, other_value]}
+            {"field_name": [self_value, other_value]}
         :param other: an instance of Flight to be compared with self
         :return: dictionary with differences
         """
         self._validate_other(other)
+        values = self._field_values(self)
+        other_values = self._field_values(other)
+        if values == other_values:
+            return {}
         diff_dict = {}
-        for prop_name, prop in self.properties.items():
-            other_property = other.properties[prop_name]
-            if other_property != prop:
-                # print(f"Difference in {prop_name}, self:{prop}, other:{other_property}")
-                diff_dict[prop_name] = [prop, other_property]
+        for field, value, other_value in zip(self.FIELDS, values, other_values):
+            if other_value != value:
+                diff_dict[field] = [value, other_value]
         return diff_dict
 
     def update_and_return_diff(self, other):
@@ -350,8 +656,8 @@ class Flight:
         :return: dictionary with differences present
         """
         diff_dict = self.compare(other)
-        for prop_name, prop in diff_dict.items():
-            self.properties[prop_name] = prop[1]
+        for field, values in diff_dict.items():
+            setattr(self, field, values[1])
         return diff_dict
 
     def __str__(self):
@@ -362,13 +668,50 @@ class Flight:
         res = ""
         res += f"Flight: {self.flight_code}\n"
         res += f"ID: {self.flight_id}"
-        for prop_name, prop in self.properties.items():
-            if prop is None:
-                prop = ""
-            res += f"\n{prop_name}: {prop}"
+        res += f"\n{self.FIELD_LABELS[0]}: {self.status or ''}"
+        for label, field in zip(self.FIELD_LABELS[1:], self.FIELDS[1:]):
+            value = getattr(self, field)
+            if value is None:
+                value = ""
+            else:
+                value = datetime.datetime.fromtimestamp(value)
+            res += f"\n{label}: {value}"
         return res
 
 
+def compute_promote_at(date: datetime.datetime) -> datetime.datetime:
+    """
+    Return the time at which the flight of the date enters the tracking window and its alert leaves frozen.
+    """
+    return date - datetime.timedelta(days=config.TRACKING_WINDOW_DAYS)
+
+
+def compute_next_check_at(flight_dict: dict, now: float) -> float:
+    """
+    Return the unix time of the next check of an active alert.
+    The interval is ACTIVE_LISTENER_CHECK_INTERVAL_FRACTION of the time to the closest departure or arrival,
+    taking the best known of the real, estimated and scheduled times.
+    :param flight_dict: the flight of the alert, as returned by Flight.to_dict
+    :param now: the current unix time
+    :return: unix time
+    """
+    distances = []
+    for moment in ("departure", "arrival"):
+        timestamp = (
+            flight_dict.get(f"real_{moment}")
+            or flight_dict.get(f"estimated_{moment}")
+            or flight_dict.get(f"scheduled_{moment}")
+        )
+        if timestamp is not None:
+            distances.append(abs(timestamp - now))
+    if distances:
+        interval = min(distances) * config.ACTIVE_LISTENER_CHECK_INTERVAL_FRACTION
+    else:
+        interval = config.ACTIVE_LISTENER_SLEEP_DURATION
+    interval = min(config.ACTIVE_LISTENER_MAX_CHECK_INTERVAL, max(config.ACTIVE_LISTENER_MIN_CHECK_INTERVAL, interval))
+    return now + interval
+
+
 class Alert:
     """
     A class representing an alert.
@@ -423,10 +766,10 @@ class Alert:
             raise TypeError("Other should be of the type Alert.")
         diff_dict = self.flight.compare(other.flight)
         reply = None
-        if "Current Status" in diff_dict:
+        if "status" in diff_dict:
             reply = f"Flight {self.flight.flight_code} on status update:\n"
-            reply += f"Old status: {diff_dict['Current Status'][0]}\n"
-            reply += f"New status: {diff_dict['Current Status'][1]}\n"
+            reply += f"Old status: {diff_dict['status'][0]}\n"
+            reply += f"New status: {diff_dict['status'][1]}\n"
         return reply
 
 
@@ -434,12 +777,42 @@ class APIClient:
     """
     A helper class to interact with the API of the flightradar24.
     """
-    def __init__(self, logger_name="API_CLIENT", logger_path="logs/api_client.log", proxies=None):
+    def __init__(
+            self,
+            logger_name="API_CLIENT",
+            logger_path="logs/api_client.log",
+            proxies=None,
+            session=None,
+            timeout=(config.API_CONNECT_TIMEOUT, config.API_READ_TIMEOUT),
+            cache=None,
+            read_cache=True,
+            rate_limiter=None,
+            proxy_pool=None,
+            api_url=config.API_URL,
+            recorder=None,
+            replayer=None):
         """
         Constructor.
         :param logger_name: the name of the logger, defaults to API_CLIENT
         :param logger_path: the file path to log into, defaults to api_client.log
         :param proxies: list of proxies to be supplied to the request methods. Defaults to None
+        :param session: requests.Session to make the requests with. Defaults to None, in which case
+            the session shared by the whole process is used (see get_http_session).
+        :param timeout: (connect, read) timeouts of a single request in seconds
+        :param cache: ResponseCache used by get_flight. Defaults to None, in which case the cache shared by
+            the process is used (see response_cache.get_response_cache), if enabled in the config.
+        :param read_cache: if False, get_flight always asks the API and only stores the responses into the cache,
+            for callers which need fresher data than API_CACHE_TTL allows
+        :param rate_limiter: RateLimiter every request waits for. Defaults to None, in which case the limiter
+            shared by all the processes is used (see rate_limiter.get_rate_limiter), if enabled in the config.
+            With the shared limiter, every proxy of the proxy pool gets a budget of its own.
+        :param proxy_pool: ProxyPool the requests are rotated over when no proxies are given. Defaults to None,
+            in which case the pool of config.API_PROXIES is used (see proxy_pool.get_proxy_pool), if any.
+        :param api_url: base url of the API, defaults to config.API_URL
+        :param recorder: ResponseRecorder every response is appended to. Defaults to None, in which case
+            the recorder of config.API_RECORD_PATH is used (see api_recorder.get_recorder), if set.
+        :param replayer: ResponseReplayer serving the responses instead of the API. Defaults to None, in which case
+            the replayer of config.API_REPLAY_PATH is used (see api_recorder.get_replayer), if set.
 
         """
         self.logger = get_logger(logger_name=logger_name, file_name=logger_path)
@@ -447,32 +820,161 @@ class APIClient:
             "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0"
         }
         self.proxies = proxies
+        self._session = session
+        self.timeout = timeout
+        if cache is None:
+            cache = get_response_cache()
+        self.cache = cache
+        self.read_cache = read_cache
+        self._shared_rate_limiter = rate_limiter is None
+        if rate_limiter is None:
+            rate_limiter = get_rate_limiter()
+        self.rate_limiter = rate_limiter
+        if proxy_pool is None:
+            proxy_pool = get_proxy_pool()
+        self.proxy_pool = proxy_pool
         self.balance_json_url = 'https://www.flightradar24.com/balance.json'
-        self.api_url = 'https://api.flightradar24.com/common/v1'
+        self.api_url = api_url
+        if recorder is None:
+            recorder = get_recorder()
+        self.recorder = recorder
+        if replayer is None:
+            replayer = get_replayer()
+        self.replayer = replayer
         self.flight_url = "/flight/list.json?&fetchBy=flight&page={}&limit=100&query={}"
         self.logger.info("API Client created")
 
+    @property
+    def session(self):
+        """
+        The session used for the requests. Resolved on every access, so that a client created before
+        a fork picks up the session of the process it runs in.
+        """
+        if self._session is not None:
+            return self._session
+        return get_http_session()
+
+    def pick_egress(self, proxies=None):
+        """
+        Decide which proxies the next request goes out through and which rate limiter it waits for.
+        Explicit proxies win over self.proxies, which win over the proxy pool.
+        :param proxies: dictionary of proxies given to make_request, None if not given
+        :return: tuple (proxies, pool_proxy, rate_limiter), pool_proxy is the proxy taken from the pool if any
+        """
+        pool_proxy = None
+        if proxies is None:
+            proxies = self.proxies
+        if proxies is None and self.proxy_pool is not None:
+            pool_proxy = self.proxy_pool.acquire()
+            proxies = {"http": pool_proxy, "https": pool_proxy}
+        rate_limiter = self.rate_limiter
+        if pool_proxy is not None and rate_limiter is not None and self._shared_rate_limiter:
+            rate_limiter = get_rate_limiter(egress=pool_proxy)
+        return proxies, pool_proxy, rate_limiter
+
+    def report_egress(self, pool_proxy, started_at, ok):
+        """
+        Report the outcome of a request to the proxy pool, if the request went through it.
+        :param pool_proxy: the proxy taken from the pool, None if the pool was not used
+        :param started_at: time.monotonic() of the start of the request
+        :param ok: False if the request failed or was throttled
+        :return: None
+        """
+        if pool_proxy is not None:
+            self.proxy_pool.report(pool_proxy, time.monotonic() - started_at, ok)
+
     def make_request(self, end_point, proxies=None):
         """
         Make the request and return the JSON of the response if successful.
         If any errors occur during the request or the error code is not ok, raise RuntimeError.
         :param end_point: the url of the endpoint which should be accessed.
-        :param proxies: list of alternative proxies. Defaults to None. If None, the self.proxies will be used.
+        :param proxies: list of alternative proxies. Defaults to None. If None, the self.proxies will be used,
+            or a proxy of the proxy pool if self.proxies is None as well.
         :return: dictionary of the response
         """
-        if proxies is None:
-            proxies = self.proxies
+        if self.replayer is not None:
+            entry = self.get_replay_entry(end_point)
+            time.sleep(self.replayer.delay(entry))
+            return self.decode_replay_entry(entry)
+
+        proxies, pool_proxy, rate_limiter = self.pick_egress(proxies)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        started_at = time.monotonic()
+        requested_at = time.time()
         try:
             self.logger.info(f"Requesting '{end_point}'")
-            r = requests.get(end_point, headers=self.request_base_headers, proxies=proxies)
+            r = self.session.get(
+                end_point,
+                headers=self.request_base_headers,
+                proxies=proxies,
+                timeout=self.timeout,
+            )
         except requests.RequestException as e:
+            self.report_egress(pool_proxy, started_at, ok=False)
+            if self.recorder is not None:
+                self.recorder.record(
+                    self.relative_endpoint(end_point), requested_at, time.monotonic() - started_at, error=str(e)
+                )
             self.logger.exception("Exception occurred during request:")
             raise RuntimeError(f"Error in request: {e}")
 
+        self.report_egress(pool_proxy, started_at, ok=r.ok)
+        if self.recorder is not None:
+            self.recorder.record(
+                self.relative_endpoint(end_point), requested_at, time.monotonic() - started_at, r.status_code, r.text
+            )
+        if rate_limiter is not None:
+            rate_limiter.report(r.status_code, parse_retry_after(r.headers.get("Retry-After")))
+
         if not r.ok:
             self.logger.error(f"Status code is not ok: {r.status_code}")
             raise RuntimeError(f"Request failed: {r.status_code}")
-        return r.json()
+        try:
+            return decode_json(r.content)
+        except ValueError as e:
+            self.logger.exception("Response is not a valid JSON:")
+            raise RuntimeError(f"Invalid response: {e}")
+
+    def relative_endpoint(self, end_point):
+        """
+        Return the endpoint relative to self.api_url, recordings are keyed by it.
+        """
+        if end_point.startswith(self.api_url):
+            return end_point[len(self.api_url):]
+        return end_point
+
+    def get_replay_entry(self, end_point):
+        """
+        Take the next recorded entry of the endpoint from the replayer.
+        :param end_point: the url of the endpoint which should be accessed.
+        :return: dictionary of the recorded request
+        Raises RuntimeError if the endpoint was not recorded.
+        """
+        self.logger.info(f"Replaying '{end_point}'")
+        try:
+            return self.replayer.next_entry(self.relative_endpoint(end_point))
+        except KeyError as e:
+            self.logger.error(f"Nothing recorded for '{end_point}'")
+            raise RuntimeError(f"Error in request: {e}")
+
+    def decode_replay_entry(self, entry):
+        """
+        Turn the recorded entry into the result of make_request, failing the same way the recorded request did.
+        :param entry: dictionary of the recorded request
+        :return: dictionary of the response
+        """
+        if entry["status"] is None:
+            self.logger.error(f"Recorded request failed: {entry['error']}")
+            raise RuntimeError(f"Error in request: {entry['error']}")
+        if entry["status"] >= 400:
+            self.logger.error(f"Status code is not ok: {entry['status']}")
+            raise RuntimeError(f"Request failed: {entry['status']}")
+        try:
+            return decode_json(entry["body"])
+        except ValueError as e:
+            self.logger.exception("Response is not a valid JSON:")
+            raise RuntimeError(f"Invalid response: {e}")
 
     def get_flight(self, flight_code, page=1):
         """
@@ -482,8 +984,33 @@ class APIClient:
         :return: return the response component from the result component if request was successful.
         Raises ValueError if the appropriate information is not found in the response.
         """
-        endpoint = self.api_url + self.flight_url.format(page, flight_code)
-        resp = self.make_request(endpoint)
+        if self.cache is not None and self.read_cache:
+            response = self.cache.get(flight_code, page)
+            if response is not None:
+                self.logger.info(f"Cache hit for {flight_code}, page {page}")
+                return response
+        resp = self.make_request(self.get_flight_endpoint(flight_code, page))
+        response = self.extract_response(resp)
+        if self.cache is not None:
+            self.cache.set(flight_code, page, response)
+        return response
+
+    def get_flight_endpoint(self, flight_code, page=1):
+        """
+        Build the url of the flight list endpoint.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: the full url
+        """
+        return self.api_url + self.flight_url.format(page, flight_code)
+
+    def extract_response(self, resp):
+        """
+        Take the response component out of the decoded json of the flight list endpoint.
+        :param resp: decoded json of the response
+        :return: the response component from the result component.
+        Raises ValueError if the appropriate information is not found in the response.
+        """
         try:
             response = resp['result']['response']
         except KeyError:
@@ -491,6 +1018,88 @@ class APIClient:
             raise ValueError("No results were found")
         return response
 
+    def get_flight_page(self, flight_code, page=1):
+        """
+        Query the API using the flight code and wrap the page into a FlightPage.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: FlightPage of the response, the flights are parsed only when matched.
+        Raises ValueError if the appropriate information is not found in the response.
+        """
+        return FlightPage(self.get_flight(flight_code, page=page))
+
+    def iter_flight_pages(self, flight_code, get_page=None, max_pages=config.API_MAX_PAGES):
+        """
+        Lazily iterate over the pages of the flight code.
+        The next page is requested only when the consumer asks for it, so stopping the iteration early
+        saves the remaining requests.
+        :param flight_code: flight code containing airline code and flight number
+        :param get_page: function (flight_code, page) -> FlightPage. Defaults to None, in which case
+            self.get_flight_page is used.
+        :param max_pages: maximum number of pages to request
+        :return: generator of FlightPage objects
+        Raises ValueError if the appropriate information is not found in a response.
+        """
+        if get_page is None:
+            get_page = self.get_flight_page
+        for page in range(1, max_pages + 1):
+            flight_page = get_page(flight_code, page)
+            if page == 1 and len(flight_page):
+                self.logger.info("Current request contains flight data, processing it")
+            yield flight_page
+            if not flight_page.has_more:
+                return
+        self.logger.warning(f"Stopped after {max_pages} pages of {flight_code}")
+
+    def find_row_by_id(self, pages, flight_id):
+        """
+        Find the row with the given flight id, stop consuming the pages as soon as it is found.
+        :param pages: iterable of FlightPage objects
+        :param flight_id: flight id given by the flightradar24 API
+        :return: tuple (FlightPage, index) of the matching row. None if not found.
+        """
+        for flight_page in pages:
+            index = flight_page.index_of(flight_id)
+            if index is not None:
+                self.logger.info("Flight with specified flight_id is found, returning it.")
+                return flight_page, index
+        self.logger.warning("Flight with specified flight_id not found, returning None")
+        return None
+
+    def find_flight_by_id(self, pages, flight_id):
+        """
+        Find the flight with the given flight id, stop consuming the pages as soon as it is found.
+        :param pages: iterable of FlightPage objects
+        :param flight_id: flight id given by the flightradar24 API
+        :return: the matching Flight object. None if not found.
+        """
+        match = self.find_row_by_id(pages, flight_id)
+        if match is None:
+            return None
+        flight_page, index = match
+        return flight_page.flight(index)
+
+    def find_flight_by_date(self, pages, date):
+        """
+        Find the flight departing on the given date, stop consuming the pages as soon as it is found.
+        The flight list of the API is ordered from the latest to the earliest departure, so the search also stops
+        at the first flight departing before the requested date.
+        :param pages: iterable of FlightPage objects
+        :param date: a datetime object with the requested flight departure date.
+        :return: the matching Flight object. None if not found.
+        """
+        day_start, day_end = FlightPage.day_bounds(date)
+        for flight_page in pages:
+            curr_flight, passed = flight_page.find_by_departure(day_start, day_end)
+            if curr_flight is not None:
+                self.logger.info("Flight with specified date is found, returning it.")
+                return curr_flight
+            if passed:
+                self.logger.info("Passed the specified date, stopping the search.")
+                break
+        self.logger.warning("Flight with specified date not found, returning None")
+        return None
+
     def get_flight_by_id(self, flight_code, flight_id):
         """
         Query the API using the flight id and flight code
@@ -498,17 +1107,15 @@ class APIClient:
         :param flight_id: flight id given by the flightradar24 API
         :return: Flight object created from the found flight data. None if not found.
         """
-        resp = self.get_flight(flight_code)
-        current_flights = resp['data']
-        if current_flights is not None:
-            self.logger.info("Current request contains flight data, processing it")
-            for flight in current_flights:
-                curr_flight = Flight.create_from_api_response(flight)
-                if curr_flight.flight_id == flight_id:
-                    self.logger.info("Flight with specified flight_id is found, returning it.")
-                    return curr_flight
-        self.logger.warning("Flight with specified flight_id not found, returning None")
-        return None
+        return self.find_flight_by_id(self.iter_flight_pages(flight_code), flight_id)
+
+    def get_row_by_id(self, flight_code, flight_id):
+        """
+        Same as get_flight_by_id, but return the row instead of a Flight, so the caller can check
+        its fingerprint before paying for the Flight.
+        :return: tuple (FlightPage, index) of the found row. None if not found.
+        """
+        return self.find_row_by_id(self.iter_flight_pages(flight_code), flight_id)
 
     def get_flight_by_date(self, flight_code, date):
         """
@@ -519,20 +1126,203 @@ class APIClient:
         :return: Flight object created from the found flight data. None if not found.
         """
         try:
-            resp = self.get_flight(flight_code)
+            return self.find_flight_by_date(self.iter_flight_pages(flight_code), date)
         except ValueError:
             self.logger.exception("No results found at all")
             raise ValueError("No results found at all")
-        current_flights = resp['data']
-        if current_flights is not None:
-            self.logger.info("Current request contains flight data, processing it")
-            for flight in current_flights:
-                curr_flight = Flight.create_from_api_response(flight)
-                curr_fl_dep = curr_flight.properties['Scheduled Departure']
-                if curr_fl_dep is None:
-                    continue
-                if (curr_fl_dep.year, curr_fl_dep.month, curr_fl_dep.day) == (date.year, date.month, date.day):
-                    self.logger.info("Flight with specified date is found, returning it.")
-                    return curr_flight
-        self.logger.warning("Flight with specified date not found, returning None")
+
+
+class FlightPage:
+    """
+    A single page of the flight list response.
+    Matching a row only reads its match key (the flight id or the scheduled departure timestamp),
+    a full Flight is created just for the matching row. The keys and the created flights are kept,
+    so a page shared between several lookups does the work only once.
+    """
+    def __init__(self, response):
+        """
+        Constructor.
+        :param response: the response component returned by APIClient.get_flight
+        """
+        self.rows = response.get('data') or []
+        page_info = response.get('page') or {}
+        if 'more' in page_info:
+            self.has_more = bool(page_info['more'])
+        else:
+            self.has_more = page_info.get('current', 1) < page_info.get('total', 1)
+        self._ids = None
+        self._departures = None
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def day_bounds(date):
+        """
+        Return the timestamps of the start of the day and the start of the next day, in the local time zone.
+        :param date: datetime or date object
+        :return: tuple (day_start, day_end)
+        """
+        day_start = datetime.datetime(year=date.year, month=date.month, day=date.day)
+        day_end = day_start + datetime.timedelta(days=1)
+        return day_start.timestamp(), day_end.timestamp()
+
+    def flight(self, index):
+        """
+        Return the Flight of the row, creating it on first use.
+        :param index: index of the row
+        :return: instance of Flight
+        """
+        with self._lock:
+            curr_flight = self._flights.get(index)
+            if curr_flight is None:
+                curr_flight = Flight.create_from_api_response(self.rows[index])
+                self._flights[index] = curr_flight
+            return curr_flight
+
+    def ids(self):
+        """
+        Return the flight ids of the rows, None for the rows without one.
+        """
+        with self._lock:
+            if self._ids is None:
+                ids = []
+                for row in self.rows:
+                    try:
+                        ids.append(row['identification']['row'])
+                    except (KeyError, TypeError):
+                        ids.append(None)
+                self._ids = ids
+            return self._ids
+
+    def departures(self):
+        """
+        Return the scheduled departure timestamps of the rows, None for the rows without one.
+        """
+        with self._lock:
+            if self._departures is None:
+                departures = []
+                for row in self.rows:
+                    try:
+                        departures.append(row['time']['scheduled']['departure'])
+                    except (KeyError, TypeError):
+                        departures.append(None)
+                self._departures = departures
+            return self._departures
+
+    def fingerprint(self, index):
+        """
+        Return the fingerprint of the row, equal to the fingerprint of its Flight, without creating the Flight.
+        :param index: index of the row
+        :return: hex digest
+        """
+        return flight_fingerprint(Flight.values_from_api_response(self.rows[index]))
+
+    def index_of(self, flight_id):
+        """
+        Return the index of the row with the flight id, None if the page has no such row.
+        """
+        for index, row_id in enumerate(self.ids()):
+            if row_id == flight_id:
+                return index
         return None
+
+    def find_by_id(self, flight_id):
+        """
+        Return the Flight with the flight id, None if the page has no such row.
+        """
+        index = self.index_of(flight_id)
+        if index is None:
+            return None
+        return self.flight(index)
+
+    def find_by_departure(self, day_start, day_end):
+        """
+        Look for the first row scheduled to depart within [day_start, day_end).
+        :param day_start: timestamp of the start of the day
+        :param day_end: timestamp of the start of the next day
+        :return: tuple (Flight or None, passed), passed is True if a row departing before day_start was reached.
+        """
+        for index, departure in enumerate(self.departures()):
+            if departure is None:
+                continue
+            if day_start <= departure < day_end:
+                return self.flight(index), False
+            if departure < day_start:
+                return None, True
+        return None, False
+
+
+class FlightLookupCoalescer:
+    """
+    A per-sweep front of the APIClient which requests every distinct flight code and page only once.
+    Concurrent lookups of the same page wait for the request already in flight and share its FlightPage,
+    so the page is also parsed only once. Create a new instance for every sweep, the results are never refreshed.
+    """
+    def __init__(self, api_client):
+        """
+        Constructor.
+        :param api_client: an instance of APIClient used to make the actual requests
+        """
+        self.api_client = api_client
+        self._lock = threading.Lock()
+        self._lookups = {}
+
+    def _claim(self, flight_code, page):
+        """
+        Return the future holding the lookup of the flight code and page, and whether the caller has to fill it.
+        Only the first caller for a flight code and page becomes the owner.
+        """
+        key = (flight_code, page)
+        with self._lock:
+            lookup = self._lookups.get(key)
+            is_owner = lookup is None
+            if is_owner:
+                lookup = Future()
+                self._lookups[key] = lookup
+        return lookup, is_owner
+
+    def get_flight_page(self, flight_code, page=1):
+        """
+        Same as APIClient.get_flight_page, but the request is made only on the first call for the flight code and page.
+        Errors are shared as well, so a failing flight code is not retried within the sweep.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: which page we are trying to access
+        :return: FlightPage of the response
+        """
+        lookup, is_owner = self._claim(flight_code, page)
+        if is_owner:
+            try:
+                lookup.set_result(self.api_client.get_flight_page(flight_code, page=page))
+            except Exception as e:
+                lookup.set_exception(e)
+        else:
+            self.api_client.logger.info(f"Reusing the lookup of {flight_code}, page {page}")
+        return lookup.result()
+
+    def get_flight_by_id(self, flight_code, flight_id):
+        """
+        Same as APIClient.get_flight_by_id, served from the shared pages of the flight code.
+        """
+        pages = self.api_client.iter_flight_pages(flight_code, get_page=self.get_flight_page)
+        return self.api_client.find_flight_by_id(pages, flight_id)
+
+    def get_row_by_id(self, flight_code, flight_id):
+        """
+        Same as APIClient.get_row_by_id, served from the shared pages of the flight code.
+        """
+        pages = self.api_client.iter_flight_pages(flight_code, get_page=self.get_flight_page)
+        return self.api_client.find_row_by_id(pages, flight_id)
+
+    def get_flight_by_date(self, flight_code, date):
+        """
+        Same as APIClient.get_flight_by_date, served from the shared pages of the flight code.
+        """
+        pages = self.api_client.iter_flight_pages(flight_code, get_page=self.get_flight_page)
+        try:
+            return self.api_client.find_flight_by_date(pages, date)
+        except ValueError:
+            self.api_client.logger.exception("No results found at all")
+            raise ValueError("No results found at all")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+try:
+    import sys
+    import time
+    import logging
+    import argparse
+    import datetime
+
+    from pymongo import IndexModel, ASCENDING
+    from pymongo.errors import PyMongoError
+
+    import config
+    from helpers import get_collection, claim_filter
+    from active_listener import ActiveListener
+    from frozen_listener import FrozenListener
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+# The indexes every collection needs, keyed by (db name, collection name)
+INDEXES = {
+    (config.AIRLINE_DESIGNATOR_DB, config.AIRLINE_DESIGNATOR_COLLECTION): [
+        IndexModel([("iata", ASCENDING)], name="iata"),
+        IndexModel([("icao", ASCENDING)], name="icao"),
+    ],
+    (config.QUEUE_ALERT_DB, config.QUEUE_COLLECTION): [
+        IndexModel([("lease_until", ASCENDING)], name="lease_until"),
+    ],
+    (config.FROZEN_ALERT_DB, config.FROZEN_ALERT_COLLECTION): [
+        IndexModel([("promote_at", ASCENDING)], name="promote_at"),
+    ],
+    (config.ACTIVE_ALERTS_DB, config.ACTIVE_ALERTS_COLLECTION): [
+        IndexModel([("next_check_at", ASCENDING)], name="next_check_at"),
+    ],
+}
+
+
+def get_queries():
+    """
+    Return the queries the bot and the listeners run, to check their plans against the indexes.
+    Returns:
+        list of tuples (description, (db name, collection name), filter, sort)
+    """
+    now = time.time()
+    today = datetime.datetime.today()
+    airlines = (config.AIRLINE_DESIGNATOR_DB, config.AIRLINE_DESIGNATOR_COLLECTION)
+    return [
+        ("airline by iata", airlines, {"iata": "FR"}, None),
+        ("airline by icao", airlines, {"icao": "RYR"}, None),
+        (
+            "claim queued alerts",
+            (config.QUEUE_ALERT_DB, config.QUEUE_COLLECTION),
+            claim_filter({}, now),
+            None,
+        ),
+        (
+            "claim frozen alerts due for promotion",
+            (config.FROZEN_ALERT_DB, config.FROZEN_ALERT_COLLECTION),
+            claim_filter(FrozenListener.due_filter(today), now),
+            [("promote_at", ASCENDING)],
+        ),
+        (
+            "next promotion",
+            (config.FROZEN_ALERT_DB, config.FROZEN_ALERT_COLLECTION),
+            claim_filter({}, now),
+            [("promote_at", ASCENDING)],
+        ),
+        (
+            "claim due active alerts",
+            (config.ACTIVE_ALERTS_DB, config.ACTIVE_ALERTS_COLLECTION),
+            claim_filter(ActiveListener.due_filter(now), now),
+            [("next_check_at", ASCENDING)],
+        ),
+        (
+            "next active check",
+            (config.ACTIVE_ALERTS_DB, config.ACTIVE_ALERTS_COLLECTION),
+            claim_filter({}, now),
+            [("next_check_at", ASCENDING)],
+        ),
+    ]
+
+
+def ensure_indexes(connection_uri=config.MONGO_CONNECTION_URI, logger=None):
+    """
+    Create the missing indexes of INDEXES, the existing ones are left as they are.
+    Arguments:
+        connection_uri: the uri of the MongoDB deployment
+        logger: logger to report to, the module logger if None
+    Returns:
+        True if every index is in place
+    """
+    logger = logger or logging.getLogger(__name__)
+    success = True
+    for (db_name, collection_name), indexes in INDEXES.items():
+        collection = get_collection(connection_uri, db_name, collection_name)
+        try:
+            names = collection.create_indexes(indexes)
+        except PyMongoError:
+            logger.exception(f"Failed to create the indexes of {db_name}.{collection_name}")
+            success = False
+        else:
+            logger.info(f"Indexes of {db_name}.{collection_name}: {', '.join(names)}")
+    return success
+
+
+def find_stages(plan, stage):
+    """
+    Return True if the explained plan, or any of its input stages, is of the given stage.
+    """
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            return True
+        return any(find_stages(value, stage) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_stages(value, stage) for value in plan)
+    return False
+
+
+def check_query_plans(connection_uri=config.MONGO_CONNECTION_URI):
+    """
+    Explain the queries of get_queries and return the ones whose winning plan scans a whole collection.
+    Run it against a deployment where ensure_indexes was run, an empty local mongod is enough.
+    Arguments:
+        connection_uri: the uri of the MongoDB deployment
+    Returns:
+        list of the descriptions of the queries planned with a COLLSCAN
+    """
+    collscans = []
+    for description, (db_name, collection_name), query, sort in get_queries():
+        cursor = get_collection(connection_uri, db_name, collection_name).find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if find_stages(winning_plan, "COLLSCAN"):
+            collscans.append(description)
+    return collscans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the MongoDB indexes and check the query plans.")
+    parser.add_argument("--uri", default=config.MONGO_CONNECTION_URI, help="defaults to the uri of the config")
+    parser.add_argument(
+        "--check-plans",
+        action="store_true",
+        help="after creating the indexes, fail if any query of the bot or the listeners scans a whole collection",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if not ensure_indexes(args.uri):
+        return 1
+    if args.check_plans:
+        collscans = check_query_plans(args.uri)
+        for description in collscans:
+            logging.error(f"COLLSCAN in the plan of: {description}")
+        if collscans:
+            return 1
+        logging.info("No query scans a whole collection.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,24 @@
 try:
     from pprint import pprint
-    import concurrent.futures
+    import asyncio
+    import functools
     from concurrent.futures import ThreadPoolExecutor
     import time
     import datetime
+    import threading
     from multiprocessing import Process
 
-    from pymongo.errors import PyMongoError
-    from pymongo import UpdateOne
-    from pymongo.collection import Collection
+    from pymongo.errors import PyMongoError, OperationFailure
     from telegram.utils.request import Request
     from telegram import Bot
 
     import config
-    from helpers import get_collection, get_logger, Flight, APIClient, Alert
+    from helpers import (
+        get_collection, get_logger, APIClient, Alert, FlightLookupCoalescer, compute_promote_at,
+        make_lease_owner, claim_alerts, iter_claims, run_bounded, strip_lease, LEASE_FIELDS,
+    )
+    from async_api_client import AsyncAPIClient, AsyncFlightLookupCoalescer
+    from bulk_write_buffer import BulkWriteBuffer
 
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
@@ -26,31 +31,10 @@ class QueueListener(Process):
         This object is to listen to the queue in the DB, and if there is anything, process it.
         """
         super().__init__()
-        self._futures = None
         self._logger = get_logger(
             logger_name="QUEUE_LISTENER",
             file_name=config.QUEUE_LISTENER_LOG_PATH,
         )
-        self.queue_collection = get_collection(
-            connection_uri=config.MONGO_CONNECTION_URI,
-            db_name=config.QUEUE_ALERT_DB,
-            collection_name=config.QUEUE_COLLECTION,
-        )
-        self.frozen_collection = get_collection(
-            connection_uri=config.MONGO_CONNECTION_URI,
-            db_name=config.FROZEN_ALERT_DB,
-            collection_name=config.FROZEN_ALERT_COLLECTION,
-        )
-        self.active_collection = get_collection(
-            connection_uri=config.MONGO_CONNECTION_URI,
-            db_name=config.ACTIVE_ALERTS_DB,
-            collection_name=config.ACTIVE_ALERTS_COLLECTION,
-        )
-        self.airline_designator_collection = get_collection(
-            connection_uri=config.MONGO_CONNECTION_URI,
-            db_name=config.AIRLINE_DESIGNATOR_DB,
-            collection_name=config.AIRLINE_DESIGNATOR_COLLECTION,
-        )
         self.thread_pool = ThreadPoolExecutor(max_workers=config.QUEUE_LISTENER_THREAD_POOL_SIZE)
         req = Request(
             connect_timeout=5,
@@ -64,11 +48,51 @@ class QueueListener(Process):
             logger_name="QUEUE_API_CLIENT",
             logger_path=config.QUEUE_API_CLIENT_LOG_PATH,
         )
+        self.async_api_client = AsyncAPIClient(
+            logger_name="QUEUE_ASYNC_API_CLIENT",
+            logger_path=config.QUEUE_ASYNC_API_CLIENT_LOG_PATH,
+        )
+        self.lease_owner = make_lease_owner("QUEUE_LISTENER")
+        self.write_buffer = BulkWriteBuffer(self._logger)
 
         self._logger.info("QueueListener created")
 
+    # The collections are resolved on every use rather than in the constructor, which runs in the parent process.
+    # The parent's MongoClient is connected by the time this process forks, so the child must not keep using it:
+    # get_collection hands out the client of the current process.
+    @property
+    def queue_collection(self):
+        return get_collection(config.MONGO_CONNECTION_URI, config.QUEUE_ALERT_DB, config.QUEUE_COLLECTION)
+
+    @property
+    def frozen_collection(self):
+        return get_collection(config.MONGO_CONNECTION_URI, config.FROZEN_ALERT_DB, config.FROZEN_ALERT_COLLECTION)
+
+    @property
+    def active_collection(self):
+        return get_collection(config.MONGO_CONNECTION_URI, config.ACTIVE_ALERTS_DB, config.ACTIVE_ALERTS_COLLECTION)
+
+    @property
+    def airline_designator_collection(self):
+        return get_collection(
+            config.MONGO_CONNECTION_URI,
+            config.AIRLINE_DESIGNATOR_DB,
+            config.AIRLINE_DESIGNATOR_COLLECTION,
+        )
+
+    def claim_batch(self):
+        """
+        Claim the next LEASE_BATCH_SIZE alerts of the queue for this listener.
+        """
+        return claim_alerts(self.queue_collection, {}, self.lease_owner, config.LEASE_BATCH_SIZE)
+
+    def iter_claimed_alerts(self):
+        """
+        Claim the alerts of the queue a window of QUEUE_LISTENER_MAX_IN_FLIGHT at a time as the sweep consumes them.
+        """
+        return iter_claims(self.queue_collection, {}, self.lease_owner, config.QUEUE_LISTENER_MAX_IN_FLIGHT)
+
     def listen_to_queue(self):
-        alerts = self.queue_collection.find({})
         try:
             num_alerts = self.queue_collection.count_documents({})
         except PyMongoError:
@@ -76,60 +100,152 @@ class QueueListener(Process):
             raise RuntimeError("Failed to get info from the DB.")
 
         self._logger.info(f"Found {num_alerts} alerts in the queue, starting to process.")
-        futures = [self.thread_pool.submit(self.process_alert, alert) for alert in alerts]
-        # for debugging purposes
-        self._futures = futures
-        for future in concurrent.futures.as_completed(futures, timeout=40):
-            if future.done():
-                self._logger.info(f"Done with the current one: {future}.")
+        # Every distinct flight code is requested once per sweep and shared between its alerts
+        flight_lookup = FlightLookupCoalescer(self.api_client)
+        deadline = time.time() + config.QUEUE_LISTENER_SWEEP_DEADLINE
+        futures = run_bounded(
+            self.thread_pool,
+            functools.partial(self.process_alert, flight_lookup=flight_lookup),
+            self.iter_claimed_alerts(),
+            config.QUEUE_LISTENER_MAX_IN_FLIGHT,
+            deadline=deadline,
+        )
+        for future in futures:
+            if future.exception() is not None:
+                self._logger.error(f"Failed to process an alert: {future.exception()!r}")
+        self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def listen_to_queue_async(self):
+        """
+        The asyncio flavour of listen_to_queue. The flight lookups run on the event loop, at most
+        QUEUE_LISTENER_ASYNC_CONCURRENCY at a time, the rest of the processing runs in the thread pool.
+        """
+        try:
+            num_alerts = self.queue_collection.count_documents({})
+        except PyMongoError:
+            self._logger.exception("Failed to get info from the DB.")
+            raise RuntimeError("Failed to get info from the DB.")
+
+        self._logger.info(f"Found {num_alerts} alerts in the queue, starting to process asynchronously.")
+        flight_lookup = AsyncFlightLookupCoalescer(self.api_client, self.async_api_client)
+        semaphore = asyncio.Semaphore(config.QUEUE_LISTENER_ASYNC_CONCURRENCY)
+        deadline = time.time() + config.QUEUE_LISTENER_SWEEP_DEADLINE
+        try:
+            while time.time() < deadline:
+                alerts = self.claim_batch()
+                if not alerts:
+                    break
+                results = await asyncio.gather(
+                    *[self.process_alert_async(alert, flight_lookup, semaphore) for alert in alerts],
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        self._logger.error(f"Failed to process an alert: {result!r}")
+        finally:
+            await self.async_api_client.close()
+            self.write_buffer.flush()
+        if time.time() >= deadline:
+            self._logger.warning("Reached the sweep deadline, leaving the remaining alerts to the next sweep.")
+        self.log_api_client_stats()
+
+    async def process_alert_async(self, alert_dict, flight_lookup, semaphore):
+        """
+        Prefetch the flight of the alert on the event loop, then process the alert in the thread pool.
+        Arguments:
+            :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: the AsyncFlightLookupCoalescer of the sweep
+            :param semaphore: asyncio.Semaphore limiting the number of lookups in flight
+        Returns:
+            None
+        """
+        if compute_promote_at(alert_dict['date']) <= datetime.datetime.today():
+            async with semaphore:
+                await flight_lookup.prefetch(alert_dict['flight_code'])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.thread_pool, self.process_alert, alert_dict, flight_lookup)
+
+    def watch_queue(self, wakeup):
+        """
+        Set the wakeup event whenever an alert is written into the queue, using a MongoDB change stream.
+        Updates which claim or release a lease are left out, or the claims of every pass would trigger the next one.
+        Returns if change streams are not supported by the deployment, the polling of run covers the queue then.
+        Arguments:
+            :param wakeup: threading.Event the run loop waits on
+        Returns:
+            None
+        """
+        lease_update = [{f"updateDescription.updatedFields.{field}": {"$exists": True}} for field in LEASE_FIELDS]
+        lease_update.append({"updateDescription.removedFields": {"$in": list(LEASE_FIELDS)}})
+        pipeline = [{"$match": {"$or": [
+            {"operationType": {"$in": ["insert", "replace"]}},
+            {"operationType": "update", "$nor": lease_update},
+        ]}}]
+        while True:
+            try:
+                with self.queue_collection.watch(pipeline) as stream:
+                    self._logger.info("Watching the queue for new alerts.")
+                    for _ in stream:
+                        wakeup.set()
+            except OperationFailure:
+                self._logger.exception("Change streams are not available, falling back to polling.")
+                return
+            except PyMongoError:
+                self._logger.exception("The change stream failed, restarting it.")
+                # The alerts written in the meantime are picked up by the polling
+                time.sleep(config.QUEUE_LISTENER_SLEEP_DURATION)
 
     def run(self):
+        wakeup = threading.Event()
+        if config.QUEUE_LISTENER_USE_CHANGE_STREAM:
+            threading.Thread(target=self.watch_queue, args=(wakeup,), daemon=True).start()
         while True:
+            # Cleared before the pass, so alerts written during it trigger the next one right away
+            wakeup.clear()
             self._logger.info("Starting to listen...")
-            self.listen_to_queue()
-            time.sleep(config.QUEUE_LISTENER_SLEEP_DURATION)
+            if config.QUEUE_LISTENER_USE_ASYNC:
+                asyncio.run(self.listen_to_queue_async())
+            else:
+                self.listen_to_queue()
+            wakeup.wait(config.QUEUE_LISTENER_SLEEP_DURATION)
 
-    def update_one(self, document: dict, collection: Collection):
-        try:
-            update_result = collection.update_one(
-                {"_id": document["_id"]},
-                {"$set": document},
-                upsert=True,
-            )
-        except PyMongoError:
-            self._logger.exception("Failed to insert into collection.")
-            raise RuntimeError("Failed to insert into collection.")
-        else:
-            return update_result
+    def log_api_client_stats(self):
+        if self.api_client.cache is not None:
+            self._logger.info(f"Response cache stats: {self.api_client.cache.stats()}")
+        if self.api_client.proxy_pool is not None:
+            self._logger.info(f"Proxy pool stats: {self.api_client.proxy_pool.stats()}")
 
-    def process_alert(self, alert_dict):
+    def process_alert(self, alert_dict, flight_lookup=None):
         """
         Process the alert from the queue, if valid, send to active, if too far, send to frozen alerts and remove
-        from the queue:
+        from the queue. The writes go through the write buffer, the user is informed once they succeeded:
         Arguments:
             :param alert_dict: dictionary containing chat_id, flight_data and date of the desired flight
+            :param flight_lookup: object used to look the flight up, the APIClient or the sweep's
+                FlightLookupCoalescer. Defaults to None, in which case self.api_client is used.
         Returns:
             None
         """
         self._logger.info(f"Checking the alert {alert_dict['_id']}")
         reply = None
-        if alert_dict['date'] - datetime.timedelta(days=9) > datetime.datetime.today():
+        document = None
+        target = None
+        if flight_lookup is None:
+            flight_lookup = self.api_client
+        promote_at = compute_promote_at(alert_dict['date'])
+        if promote_at > datetime.datetime.today():
             self._logger.info("Flight date is too far from today, adding it to frozen")
-            try:
-                update_res = self.update_one(alert_dict, self.frozen_collection)
-            except RuntimeError:
-                self._logger.exception("Failed to insert into frozen collection. Leaving it in queue.")
-                raise RuntimeError("")
-            else:
-                if not update_res.acknowledged:
-                    self._logger.warning(f"Alert {alert_dict} was not inserted into frozen collection.")
-                else:
-                    self._logger.info(f"Inserted {alert_dict['_id']} alert into frozen")
-                    reply = f"Flight {alert_dict['flight_code']} is too far from today, I will keep my eye on it ;)"
+            alert_dict['promote_at'] = promote_at
+            document = strip_lease(alert_dict)
+            target = self.frozen_collection
+            reply = f"Flight {alert_dict['flight_code']} is too far from today, I will keep my eye on it ;)"
         # The case when the alert is not too far from today.
         else:
             try:
-                flight = self.api_client.get_flight_by_date(alert_dict['flight_code'], alert_dict['date'])
+                flight = flight_lookup.get_flight_by_date(alert_dict['flight_code'], alert_dict['date'])
             except ValueError:
                 self._logger.exception("No results found at all")
                 reply = f"I could not find flight {alert_dict['flight_code']}"
@@ -138,24 +254,28 @@ class QueueListener(Process):
                 if flight is None:
                     reply = f"Sorry I did not find {alert_dict['flight_code']}"
                     reply += f" on {alert_dict['date'].strftime('%d/%m/%Y')}."
-                elif flight.properties["Real Arrival"] is not None:
+                elif flight.real_arrival is not None:
                     self._logger.info("This flight has already arrived.")
                     reply = f"- - Your flight has already arrived - -\n"
                     reply += str(flight)
-                elif flight.properties['Current Status'] == "Unknown":
+                elif flight.status == "Unknown":
                     self._logger.warning("Current status is missing.")
                     reply = f"Hmm, looks like I don't have info about your {flight.flight_code} flight."
                 else:
                     self._logger.info("Flight found, processing it.")
                     alert = Alert(flight=flight, chat_id=alert_dict['chat_id'], alert_id=alert_dict["_id"])
                     reply = str(alert.flight)
+                    document = alert.to_dict()
+                    target = self.active_collection
 
-                    self._logger.info(f"Inserting {alert_dict['_id']} into active")
-                    self.update_one(alert.to_dict(), self.active_collection)
-        if reply is not None:
-            self.bot.send_message(
-                chat_id=alert_dict['chat_id'],
-                text=reply,
+        inform_user = functools.partial(self.bot.send_message, chat_id=alert_dict['chat_id'], text=reply)
+        if document is not None:
+            self._logger.info(f"Moving {alert_dict['_id']} from queue into {target.name}")
+            self.write_buffer.move(
+                document, self.queue_collection, target, on_success=inform_user, owner=self.lease_owner
+            )
+        else:
+            self._logger.info(f"Removing {alert_dict['_id']} from queue")
+            self.write_buffer.delete(
+                self.queue_collection, alert_dict['_id'], on_success=inform_user, owner=self.lease_owner
             )
-        self._logger.info(f"Removing {alert_dict['_id']} from queue")
-        self.queue_collection.delete_one({"_id": alert_dict['_id']})
@@ -0,0 +1,176 @@
+try:
+    import os
+    import json
+    import time
+    import fcntl
+    import hashlib
+    import threading
+
+    import config
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+
+class RateLimiter:
+    """
+    A token bucket limiting the requests to the upstream API.
+    The state of the bucket is kept in a small file guarded by an exclusive lock, so every thread and process
+    of the host draws from the same bucket.
+    The rate adapts to the upstream: every throttled (429) or failed (5xx) response multiplies it by backoff_factor,
+    every successful one adds recovery_step to it, within [min_rate, max_rate].
+    """
+    def __init__(
+            self,
+            path=config.API_RATE_LIMIT_PATH,
+            max_rate=config.API_RATE_LIMIT_MAX_RATE,
+            min_rate=config.API_RATE_LIMIT_MIN_RATE,
+            burst=config.API_RATE_LIMIT_BURST,
+            backoff_factor=config.API_RATE_LIMIT_BACKOFF_FACTOR,
+            recovery_step=config.API_RATE_LIMIT_RECOVERY_STEP):
+        """
+        Constructor.
+        :param path: the file path of the shared state, created if missing
+        :param max_rate: maximum number of requests per second
+        :param min_rate: the rate never drops below this number of requests per second
+        :param burst: maximum number of tokens the bucket holds
+        :param backoff_factor: the rate is multiplied by this factor after a 429 or 5xx response
+        :param recovery_step: the rate is increased by this number after a successful response
+        """
+        self.path = path
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.backoff_factor = backoff_factor
+        self.recovery_step = recovery_step
+        # flock does not exclude the threads of the same process from each other
+        self._thread_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _update(self, func):
+        """
+        Load the shared state under the lock, let func modify it and save it.
+        :param func: function (state, now) -> result, modifies the state in place
+        :return: the result of func
+        """
+        with self._thread_lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                raw = os.read(fd, 4096)
+                try:
+                    state = json.loads(raw)
+                except ValueError:
+                    state = {"tokens": self.burst, "updated_at": now, "rate": self.max_rate, "blocked_until": 0}
+                # The limits may have changed in the config since the state was written
+                state["rate"] = min(self.max_rate, max(self.min_rate, state["rate"]))
+                # Refill the bucket for the time passed since the last update
+                elapsed = max(0.0, now - state["updated_at"])
+                state["tokens"] = min(self.burst, state["tokens"] + elapsed * state["rate"])
+                state["updated_at"] = now
+                result = func(state, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, json.dumps(state).encode())
+                return result
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def try_acquire(self):
+        """
+        Take a token from the bucket if there is one.
+        :return: 0 if the token is taken, otherwise the number of seconds to wait before trying again
+        """
+        def take(state, now):
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0
+            return (1 - state["tokens"]) / state["rate"]
+
+        return self._update(take)
+
+    def acquire(self):
+        """
+        Block until a token is taken from the bucket.
+        :return: None
+        """
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def report(self, status_code, retry_after=None):
+        """
+        Adapt the rate to the status code of a response.
+        :param status_code: the HTTP status code of the response
+        :param retry_after: seconds the upstream asked to wait (the Retry-After header), if any
+        :return: the new rate
+        """
+        throttled = status_code == 429 or status_code >= 500
+
+        def adapt(state, now):
+            if throttled:
+                state["rate"] = max(self.min_rate, state["rate"] * self.backoff_factor)
+                state["tokens"] = min(state["tokens"], 0)
+                if retry_after is not None:
+                    state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+            else:
+                state["rate"] = min(self.max_rate, state["rate"] + self.recovery_step)
+            return state["rate"]
+
+        return self._update(adapt)
+
+    @property
+    def rate(self):
+        """
+        The current number of requests per second.
+        """
+        return self._update(lambda state, now: state["rate"])
+
+
+def parse_retry_after(value):
+    """
+    Parse the number of seconds from the Retry-After header.
+    :param value: the value of the header, None if it is missing
+    :return: number of seconds or None if missing or given as an HTTP date
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(egress=None):
+    """
+    Return the rate limiter of the process for the egress, creating it on first use.
+    The limiters of every process share the state file, requests going out through a proxy get a state file,
+    and so a budget, of their own.
+    Return None if the rate limiting is disabled in the config.
+    :param egress: the proxy url the requests go out through, None for direct requests
+    """
+    if not config.API_RATE_LIMIT_ENABLED:
+        return None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(egress)
+        if limiter is None:
+            path = config.API_RATE_LIMIT_PATH
+            if egress is not None:
+                root, ext = os.path.splitext(path)
+                path = f"{root}_{hashlib.sha1(egress.encode()).hexdigest()[:12]}{ext}"
+            limiter = RateLimiter(path=path)
+            _rate_limiters[egress] = limiter
+    return limiter
@@ -0,0 +1,169 @@
+try:
+    import os
+    import json
+    import time
+    import sqlite3
+    import threading
+
+    import config
+
+except ImportError as exc:
+    raise ImportError(f'Error occurred during import: {exc}\
+    Please install all necessary libraries and try again')
+
+# orjson is optional, it only makes encoding and decoding the cached responses faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ResponseCache:
+    """
+    A TTL cache of flightradar24 responses keyed by flight code and page.
+    The entries are kept in a local sqlite database, so every process on the host shares them:
+    a lookup made by the queue listener process is reused by the active and frozen listener threads and vice versa.
+    When the cache grows over max_entries, the least recently used entries are evicted.
+    """
+    def __init__(self, path=config.API_CACHE_PATH, ttl=config.API_CACHE_TTL, max_entries=config.API_CACHE_MAX_ENTRIES):
+        """
+        Constructor.
+        :param path: the file path of the sqlite database, created if missing
+        :param ttl: number of seconds a response stays valid
+        :param max_entries: maximum number of responses to keep
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "flight_code TEXT NOT NULL, "
+                "page INTEGER NOT NULL, "
+                "stored_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL, "
+                "body TEXT NOT NULL, "
+                "PRIMARY KEY (flight_code, page))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _connect(self):
+        """
+        Return the sqlite connection of the current thread, sqlite connections can not be shared between threads
+        or forked processes.
+        """
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, flight_code, page=1):
+        """
+        Return the cached response of the flight code and page.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: the page of the response
+        :return: the decoded response, None if there is no valid entry.
+        """
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT body FROM responses WHERE flight_code = ? AND page = ? AND stored_at > ?",
+                (flight_code, page, now - self.ttl),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE flight_code = ? AND page = ?",
+                    (now, flight_code, page),
+                )
+        except sqlite3.Error:
+            row = None
+        self._count(row is not None)
+        if row is None:
+            return None
+        if orjson is not None and config.API_USE_ORJSON:
+            return orjson.loads(row[0])
+        return json.loads(row[0])
+
+    def set(self, flight_code, page, response):
+        """
+        Store the response of the flight code and page, then evict expired and least recently used entries.
+        :param flight_code: flight code containing airline code and flight number
+        :param page: the page of the response
+        :param response: JSON serializable response
+        :return: None
+        """
+        now = time.time()
+        if orjson is not None and config.API_USE_ORJSON:
+            body = orjson.dumps(response).decode()
+        else:
+            body = json.dumps(response)
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (flight_code, page, stored_at, accessed_at, body) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (flight_code, page, now, now, body),
+            )
+            conn.execute("DELETE FROM responses WHERE stored_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM responses WHERE rowid IN ("
+                "SELECT rowid FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        except sqlite3.Error:
+            # A failing cache should never fail the lookup itself
+            pass
+
+    def stats(self):
+        """
+        Return the hit and miss counters of this process.
+        :return: dictionary with hits, misses and hit_ratio
+        """
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else 0.0,
+        }
+
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the response cache shared by everything in the current process, creating it on first use.
+    Return None if the cache is disabled in the config.
+    """
+    if not config.API_CACHE_ENABLED:
+        return None
+    pid = os.getpid()
+    with _response_caches_lock:
+        cache = _response_caches.get(pid)
+        if cache is None:
+            cache = ResponseCache()
+            _response_caches[pid] = cache
+    return cache
@@ -1,9 +1,11 @@
 from active_listener import ActiveListener
 from frozen_listener import FrozenListener
 from queue_listener import QueueListener
+from indexes import ensure_indexes
 
 
 def main():
+    ensure_indexes()
     a = ActiveListener()
     f = FrozenListener()
     q = QueueListener()
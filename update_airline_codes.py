@@ -3,13 +3,23 @@
 try:
     import time
     import json
-    
-    from pymongo import MongoClient
-    from pymongo import UpdateOne
+    import hashlib
+    import argparse
+    import threading
+    import multiprocessing
+    from urllib.parse import urlsplit
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    from pymongo import UpdateOne, DeleteOne
     import requests
     from bs4 import BeautifulSoup
+    from lxml import etree
 
     import config as config
+    from helpers import get_collection, create_http_session
+    from rate_limiter import RateLimiter, parse_retry_after
+    from airline_designators import DesignatorSnapshot, flatten_airlines
 except ImportError as exc:
     raise ImportError(f'Error occurred during import: {exc}\
     Please install all necessary libraries and try again')
@@ -30,7 +40,7 @@ def get_country_list():
         If no countries found, returning empty list.
     """
     try:
-        resp = requests.get(config.COUNTRIES_URL)
+        resp = requests.get(config.COUNTRIES_URL, timeout=config.SCRAPE_TIMEOUT)
     except Exception as e:
         raise ValueError(f"Failed to make the request: {e}")
     if not resp.ok:
@@ -55,31 +65,131 @@ def get_country_list():
     return countries
 
 
-def scrape_all_countries(countries):
+class PoliteFetcher:
+    """
+        Makes the scraping requests through a single keep-alive session, shared by the worker threads.
+        Every host gets at most max_per_host requests in flight and a token bucket of its own,
+        which slows down on 429 and 5xx responses.
+        Failed requests, throttled and 5xx responses are retried with an exponential backoff.
+    """
+    def __init__(
+            self,
+            max_per_host=config.SCRAPE_MAX_PER_HOST,
+            rate=config.SCRAPE_RATE_LIMIT,
+            retries=config.SCRAPE_RETRIES,
+            backoff=config.SCRAPE_RETRY_BACKOFF,
+            timeout=config.SCRAPE_TIMEOUT):
+        """
+            Args:
+                max_per_host: maximum number of requests in flight to a single host
+                rate: maximum number of requests per second to a single host
+                retries: number of times a failed request is retried
+                backoff: seconds to wait before the first retry, doubled for every further one
+                timeout: (connect, read) timeouts of a single request in seconds
+        """
+        self.session = create_http_session(pool_maxsize=max_per_host)
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # host -> (semaphore, RateLimiter)
+        self._hosts = {}
+
+    def _host_limits(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            limits = self._hosts.get(host)
+            if limits is None:
+                limiter = RateLimiter(
+                    path=config.SCRAPE_RATE_LIMIT_PATH.format(host=host.replace(":", "_")),
+                    max_rate=self.rate,
+                    min_rate=min(self.rate, config.SCRAPE_RATE_LIMIT_MIN_RATE),
+                    burst=self.max_per_host,
+                )
+                limits = (threading.BoundedSemaphore(self.max_per_host), limiter)
+                self._hosts[host] = limits
+        return limits
+
+    def post(self, url, data, headers):
+        """
+            Post the form and return the response text.
+            Raises ValueError once the retries are used up.
+        """
+        semaphore, limiter = self._host_limits(url)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            limiter.acquire()
+            with semaphore:
+                try:
+                    resp = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+                except requests.RequestException as e:
+                    error = ValueError(f"Failed to make the request: {e}")
+                    continue
+            limiter.report(resp.status_code, parse_retry_after(resp.headers.get("Retry-After")))
+            if resp.status_code == 429 or resp.status_code >= 500:
+                error = ValueError(f"Response has error code:{resp.status_code}")
+                continue
+            if not resp.ok:
+                raise ValueError(f"Response has error code:{resp.status_code}")
+            return resp.text
+        raise error
+
+
+def scrape_all_countries(
+        countries,
+        max_workers=config.SCRAPE_MAX_WORKERS,
+        parse_processes=config.SCRAPE_PARSE_PROCESSES):
     """
         Take the list of all countries 
             and parse all airlines from all countries.
         Args:
             countries: list of countries
+            max_workers: number of countries requested at a time
+            parse_processes: number of processes parsing the html, 0 to parse it in the requesting threads
         Return:
-            airlines_data: dictionary {country: [list of airlines]} format
+            airlines_data: dictionary {country: [list of airlines]} format, in the order of countries
         If an error occurred while parsing any of the countries, we skip over.
     """
-    airlines_data = {}
-    data = config.DATA.copy()
-    headers = config.HEADERS
-    url = config.AIRLINE_INFO_URL
+    fetcher = PoliteFetcher()
+    parse_pool = None
+    if parse_processes > 0:
+        # Spawned, forking a process running the scraping threads could copy a held lock into the child
+        parse_pool = ProcessPoolExecutor(max_workers=parse_processes, mp_context=multiprocessing.get_context("spawn"))
 
-    for country in countries:
+    def scrape(country):
+        data = config.DATA.copy()
         data["country"] = country
         print(f"Trying to parse {country}")
         try:
-            country_info = parse_country(url, data, headers)
-            airlines_data[country] = country_info
-            print(f"{country} has been parsed.")
+            html = fetcher.post(config.AIRLINE_INFO_URL, data, config.HEADERS)
+            country_info = None
+            if parse_pool is not None:
+                try:
+                    country_info = parse_pool.submit(parse_airlines, html).result()
+                except BrokenProcessPool:
+                    print(f"The parse processes died, parsing {country} in the thread")
+            if country_info is None:
+                country_info = parse_airlines(html)
         except ValueError as e:
             print(f"Failed to parse {country}, skipping: {e}")
-        
+            return None
+        print(f"{country} has been parsed.")
+        return country_info
+
+    airlines_data = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for country, country_info in zip(countries, executor.map(scrape, countries)):
+                if country_info is not None:
+                    airlines_data[country] = country_info
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
     return airlines_data
 
 
@@ -97,20 +207,42 @@ def parse_country(url, data, headers):
         If any error occurred while making the request or parsing html code,
         a ValueError is being raised.
     """
-    try:
-        resp = requests.post(
-                url,
-                data=data,
-                headers=headers,
-                )
-    except Exception as e:
-        raise ValueError(f"Failed to make the request: {e}")
+    return parse_airlines(PoliteFetcher().post(url, data, headers))
+
+
+def parse_airlines(html, engine=None):
+    """
+        Parse the airlines from the html of a country's result page.
+        Module level, so it can run in a process pool.
+        Args:
+            html: the text of the response
+            engine: name of the extraction engine in PARSE_ENGINES, SCRAPE_PARSE_ENGINE if None
+        Returns:
+            airlines: list of airlines of the page
+
+        If the html can not be parsed, a ValueError is being raised.
+    """
+    return PARSE_ENGINES[engine or config.SCRAPE_PARSE_ENGINE](html)
 
-    if not resp.ok:
-        raise ValueError(f"Response has error code:{resp.status_code}")
 
+def detect_designators(airline, cell_text):
+    """
+        Run the detectors against the text of a td and save what they match into the airline.
+    """
+    # For each td, iterate over detectors and try to match it
+    for detector_name, detector in config.AIRLINE_DESIGNATOR_DETECTORS.items():
+        # If detector matches, scrap and strip the info and save
+        if cell_text.startswith(detector):
+            # If parsed info is empty, set it to None
+            airline[detector_name] = cell_text[len(detector):].strip("* ") or None
+
+
+def parse_airlines_bs4(html):
+    """
+        The BeautifulSoup engine of parse_airlines, builds the whole tree and walks every div.
+    """
     try:
-        soup = BeautifulSoup(resp.text, 'lxml')
+        soup = BeautifulSoup(html, 'lxml')
     except Exception as e:
         raise ValueError(f"Something wrong in the response text: {e}")
 
@@ -126,19 +258,53 @@ def parse_country(url, data, headers):
         current_airline["name"] = item.td.text
         # Iterate over td tags and try to detect info
         for curr_row in item.table.findAll("td"):
-            # For each td, iterate over detectors and try to match it
-            for detector_name, detector in config.AIRLINE_DESIGNATOR_DETECTORS.items():
-                # If detector matches, scrap and strip the info and save
-                if curr_row.text.startswith(detector):
-                    current_airline[detector_name] = curr_row.text[len(detector):].strip("* ")
-                    # If parsed info is empty, set it to None
-                    if current_airline[detector_name] == "":
-                        current_airline[detector_name] = None
+            detect_designators(current_airline, curr_row.text)
         airlines.append(current_airline)
 
     return airlines
 
 
+# The record divs are the ones whose first paragraph reads "Current Record",
+# selected by libxml2 instead of walking every div in Python
+_RECORD_DIVS = etree.XPath('//div[string((.//p)[1]) = "Current Record"]')
+_FIRST_CELL_TEXT = etree.XPath('string((.//td)[1])')
+_RECORD_CELLS = etree.XPath('(.//table)[1]//td')
+_TEXT = etree.XPath('string()')
+
+
+def parse_airlines_lxml(html):
+    """
+        The lxml engine of parse_airlines, returns the same records as parse_airlines_bs4.
+    """
+    if isinstance(html, str):
+        # lxml refuses str documents declaring their own encoding
+        html = html.encode("utf-8")
+    if not html.strip():
+        return []
+    try:
+        root = etree.fromstring(html, etree.HTMLParser(encoding="utf-8"))
+    except (etree.LxmlError, ValueError) as e:
+        raise ValueError(f"Something wrong in the response text: {e}")
+    if root is None:
+        return []
+
+    airlines = []
+    for item in _RECORD_DIVS(root):
+        # The smart strings of XPath keep a reference to their tree, plain ones are cheaper to keep and pickle
+        current_airline = {"name": str(_FIRST_CELL_TEXT(item))}
+        for cell in _RECORD_CELLS(item):
+            detect_designators(current_airline, str(_TEXT(cell)))
+        airlines.append(current_airline)
+
+    return airlines
+
+
+PARSE_ENGINES = {
+    "bs4": parse_airlines_bs4,
+    "lxml": parse_airlines_lxml,
+}
+
+
 def write_to_a_file(data, file_path=None):
     """
         Take the data and file path and write json to that file
@@ -161,6 +327,166 @@ def write_to_a_file(data, file_path=None):
         json.dump(data, f, indent=2)
 
 
+def load_previous(file_path=None):
+    """
+        Read the airlines written by the previous run.
+        Arguments:
+            file_path: the json written by write_to_a_file, AIRLINE_IATA_ICAO_JSON if None
+        Returns:
+            dictionary {country: [list of airlines]}, empty if there is no readable previous file
+    """
+    try:
+        with open(file_path or config.AIRLINE_IATA_ICAO_JSON) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"No previous airlines to compare with: {e}")
+        return {}
+
+
+def check_shrink(previous, countries=None, airlines=None, min_ratio=config.SCRAPE_MIN_SHRINK_RATIO):
+    """
+        Guard against replacing the previous airlines with the result of a broken run,
+        for example an error page in place of the list of countries.
+        Arguments:
+            previous: dictionary of the previous airlines {country:[list of airlines]}
+            countries: list of the countries on the site, None to not check it
+            airlines: dictionary of the new airlines {country:[list of airlines]}, None to not check it
+            min_ratio: the run is refused below this fraction of the previous countries or airlines
+        Returns:
+            None
+        Raises ValueError if the countries or the airlines shrank below min_ratio of the previous ones.
+    """
+    if countries is not None and len(countries) < min_ratio * len(previous):
+        raise ValueError(f"The site lists {len(countries)} countries, the previous run had {len(previous)}")
+    if airlines is not None:
+        count = sum(len(country_airlines) for country_airlines in airlines.values())
+        previous_count = sum(len(country_airlines) for country_airlines in previous.values())
+        if count < min_ratio * previous_count:
+            raise ValueError(f"Found {count} airlines, the previous run had {previous_count}")
+
+
+def keep_missing_countries(airlines, previous, countries):
+    """
+        Take the airlines of the countries which failed to scrape from the previous run,
+        so a failed request is not mistaken for the airlines of a country being gone.
+        A previous country missing from the list of the site is only dropped once its own page
+        was scraped and holds no airline, otherwise it keeps its airlines as well.
+        Arguments:
+            airlines: dictionary of the scraped airlines {country:[list of airlines]},
+                of the listed countries and of the previous ones missing from the list
+            previous: dictionary of the previous airlines {country:[list of airlines]}
+            countries: list of the countries on the site
+        Returns:
+            dictionary {country:[list of airlines]}
+    """
+    merged = {}
+    for country in countries:
+        if country in airlines:
+            merged[country] = airlines[country]
+        elif country in previous:
+            merged[country] = previous[country]
+    for country, country_airlines in previous.items():
+        if country in merged:
+            continue
+        scraped = airlines.get(country)
+        if scraped is None:
+            merged[country] = country_airlines
+        elif scraped:
+            merged[country] = scraped
+    return merged
+
+
+def airline_id(country, airline):
+    # Id of the airline is the concatenation of the country and full_name
+    return f"{country}_{airline['full_name']}"
+
+
+def content_hash(value):
+    """
+        Return a stable hash of JSON serializable data.
+    """
+    return hashlib.blake2b(json.dumps(value, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def hash_records(country, country_airlines):
+    """
+        Hash the airlines of a country one by one.
+        Returns:
+            dictionary {airline id: record hash}
+    """
+    return {airline_id(country, airline): content_hash(airline) for airline in country_airlines}
+
+
+def diff_airlines(previous, airlines):
+    """
+        Compare the airlines with the previous ones, country by country and then record by record.
+        The records of a country whose hash did not change are not looked at.
+        Arguments:
+            previous: dictionary of the previous airlines {country:[list of airlines]}
+            airlines: dictionary of the current airlines {country:[list of airlines]}
+        Returns:
+            tuple (documents, deleted_ids, summary).
+            documents are the inserted and changed airlines with their country and _id,
+            deleted_ids the _ids of the airlines which are gone,
+            summary a dictionary of the counts.
+    """
+    summary = dict.fromkeys(
+        ("unchanged_countries", "changed_countries", "inserted", "changed", "deleted", "unchanged"),
+        0,
+    )
+    documents = []
+    deleted_ids = []
+    for country in airlines.keys() | previous.keys():
+        current = airlines.get(country, [])
+        if content_hash(current) == content_hash(previous.get(country, [])):
+            summary["unchanged_countries"] += 1
+            summary["unchanged"] += len(current)
+            continue
+        summary["changed_countries"] += 1
+        current_records = hash_records(country, current)
+        previous_records = hash_records(country, previous.get(country, []))
+        for airline in airlines.get(country, []):
+            _id = airline_id(country, airline)
+            previous_record = previous_records.get(_id)
+            if previous_record == current_records[_id]:
+                summary["unchanged"] += 1
+                continue
+            summary["inserted" if previous_record is None else "changed"] += 1
+            documents.append(dict(airline, country=country, _id=_id))
+        gone = previous_records.keys() - current_records.keys()
+        summary["deleted"] += len(gone)
+        deleted_ids.extend(gone)
+    return documents, deleted_ids, summary
+
+
+def write_changes(documents, deleted_ids, collection, batch_size=1000):
+    """
+        Upsert the changed airlines and delete the gone ones with unordered bulk writes.
+        Arguments:
+            documents: airlines with their country and _id
+            deleted_ids: _ids of the airlines to delete
+            collection: Mongodb collection object
+            batch_size: number of writes sent at a time
+        Returns:
+            True if every write was acknowledged
+    """
+    writes = [UpdateOne({"_id": doc["_id"]}, {"$set": doc}, upsert=True) for doc in documents]
+    writes += [DeleteOne({"_id": _id}) for _id in deleted_ids]
+    acknowledged = True
+    for start in range(0, len(writes), batch_size):
+        batch = writes[start:start + batch_size]
+        write_resp = collection.bulk_write(batch, ordered=False)
+        if write_resp.acknowledged:
+            print(
+                f"Upserted {write_resp.upserted_count}, modified {write_resp.modified_count} "
+                f"and deleted {write_resp.deleted_count} out of {len(batch)}."
+            )
+        else:
+            print(f"Bulk write operation did not acknowledge {len(batch)} writes.")
+            acknowledged = False
+    return acknowledged
+
+
 def organize_and_upsert(airlines, collection):
     """
         Take the airlines info, reorganize and insert into mongodb.
@@ -176,9 +502,7 @@ def organize_and_upsert(airlines, collection):
     docs = []
     for country, country_airlines in airlines.items():
         for airline in country_airlines:
-            airline["country"] = country
-            # Id of the airline is the concatenation of the country and full_name
-            airline["_id"] = airline["country"] + "_" + airline["full_name"]
+            airline = dict(airline, country=country, _id=airline_id(country, airline))
             docs.append(airline)
             curr_update = UpdateOne(
                     {"_id": airline["_id"]},
@@ -207,6 +531,7 @@ def organize_and_upsert(airlines, collection):
             print(f"Bulk write operation did not acknowledge: {updates}")
     if updates:
         print(f"Some updates did not get written to the DB: {len(updates)}")
+    return not updates
 
 
 def setup_mongo():
@@ -216,28 +541,84 @@ def setup_mongo():
         Returns:
             collection: MongoDB collection object
     """
-    mongo_client = MongoClient(config.MONGO_CONNECTION_URI)
-    db = mongo_client[config.AIRLINE_DESIGNATOR_DB]
-    collection = db[config.AIRLINE_DESIGNATOR_COLLECTION]
-    return collection
+    return get_collection(
+        connection_uri=config.MONGO_CONNECTION_URI,
+        db_name=config.AIRLINE_DESIGNATOR_DB,
+        collection_name=config.AIRLINE_DESIGNATOR_COLLECTION,
+    )
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape the airline designators and update the json and MongoDB.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.SCRAPE_MAX_WORKERS,
+        help="number of countries requested at a time, 1 to scrape them one by one",
+    )
+    parser.add_argument(
+        "--parse-processes",
+        type=int,
+        default=config.SCRAPE_PARSE_PROCESSES,
+        help="number of processes parsing the html, 0 to parse it in the requesting threads",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="upsert every airline into MongoDB instead of only the ones changed since the previous run",
+    )
+    parser.add_argument(
+        "--allow-shrink",
+        action="store_true",
+        help="accept a run finding far fewer countries or airlines than the previous one (SCRAPE_MIN_SHRINK_RATIO)",
+    )
+    args = parser.parse_args(argv)
 
-def main():
+    previous = load_previous()
     try:
         countries = get_country_list()
     except ValueError as err:
         raise ValueError(f"Could not parse the list of countries: {err}")
+    if not countries:
+        raise ValueError("The site lists no countries, leaving the airlines as they are")
+    if not args.allow_shrink:
+        check_shrink(previous, countries=countries)
+    # The previous countries missing from the list are scraped as well, to confirm they are gone
+    listed = set(countries)
+    vanished = [country for country in previous if country not in listed]
     try:
-        airlines = scrape_all_countries(countries)
+        airlines = scrape_all_countries(countries + vanished, args.workers, args.parse_processes)
     except ValueError as err:
         raise ValueError(f"Failed to parse airline info: {err}")
-    
-    write_to_a_file(airlines)
+    airlines = keep_missing_countries(airlines, previous, countries)
+    if not args.allow_shrink:
+        check_shrink(previous, airlines=airlines)
+
+    documents, deleted_ids, summary = diff_airlines(previous, airlines)
+    print(
+        f"Countries: {summary['changed_countries']} changed, {summary['unchanged_countries']} unchanged. "
+        f"Airlines: {summary['inserted']} inserted, {summary['changed']} changed, "
+        f"{summary['deleted']} deleted, {summary['unchanged']} unchanged."
+    )
 
     # If you want to enable mongo writing, update the config file.
     if config.WRITE_TO_MONGO:
         collection = setup_mongo()
-        organize_and_upsert(airlines, collection)
+        if args.full:
+            written = organize_and_upsert(airlines, collection)
+        else:
+            written = write_changes(documents, deleted_ids, collection)
+        # The json is what the next run diffs against, it must not get ahead of the collection
+        if not written:
+            raise ValueError("Not every write reached MongoDB, leaving the json as it was for the next run")
+
+    write_to_a_file(airlines)
+    # Written after the json, so the snapshot records the json it was made of and is not rebuilt on startup
+    DesignatorSnapshot.write(
+        flatten_airlines(airlines),
+        config.AIRLINE_DESIGNATOR_SNAPSHOT,
+        source_path=config.AIRLINE_IATA_ICAO_JSON,
+    )
 
 
 if __name__ == "__main__":